@@ -0,0 +1,224 @@
+import argparse
+import itertools
+import os
+import queue
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from stockfish import Stockfish
+
+from engine_tuning import CONFIG_PATH, engine_parameters, load_config
+
+ADDRESS = ("localhost", 6000)
+# Requests are pickled, so only processes that can read this machine's key may connect
+AUTHKEY_PATH = os.path.join(os.path.dirname(CONFIG_PATH), "analysis_service.key")
+DEPTH = 15  # Stockfish wrapper default
+
+
+def load_authkey(path=AUTHKEY_PATH):
+    """Returns this machine's service key, generating it readable by this user only on first use."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "rb") as f:
+            return f.read()
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def analyse(engine, fen):
+    """Returns the evaluation, WDL and best move of a position, as classes.record_move stores them."""
+    # Keep the hash table, consecutive positions of a game share most of it
+    engine.set_fen_position(fen, send_ucinewgame_token=False)
+    return {"eval": engine.get_evaluation(), "wdl": engine.get_wdl_stats(), "best_move": engine.get_best_move()}
+
+
+class LocalAnalyser:
+    def __init__(self, engine):
+        """Analyses positions on an engine in this process, when no service is running."""
+        self.engine = engine
+
+    def analyse(self, fen, depth=DEPTH):
+        self.engine.set_depth(depth)
+        return analyse(self.engine, fen)
+
+
+class AnalysisService:
+    def __init__(self, path, engines=2, address=ADDRESS, cache_size=4096):
+        """Serves position analysis to GUI processes over a local socket.
+
+        Requests for a position already queued or being searched are attached
+        to that search instead of starting another, and finished results are
+        kept in an LRU cache, so each position is searched once however many
+        clients ask. Searches run on a fixed pool of engines fed from one queue
+        and results are sent back to each client as soon as they are ready.
+
+        Args:
+          path: stockfish binary
+          engines: number of engine processes in the pool
+          address: (host, port) to listen on
+          cache_size: number of results kept
+        """
+        parameters = engine_parameters(load_config())
+        self.engines = [Stockfish(path=path, parameters=parameters) for _ in range(engines)]
+        self.listener = Listener(address, authkey=load_authkey())
+        self.work = queue.Queue()
+        self.lock = threading.Lock()
+        self.waiting = {}  # (fen, depth) -> [(reply, request id)]
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.counts = {"requests": 0, "coalesced": 0, "cached": 0, "searched": 0}
+
+    def serve_forever(self):
+        for engine in self.engines:
+            threading.Thread(target=self.search, args=(engine,), daemon=True).start()
+        while True:
+            conn = self.listener.accept()
+            threading.Thread(target=self.serve_client, args=(conn,), daemon=True).start()
+
+    def serve_client(self, conn):
+        send_lock = threading.Lock()
+
+        def reply(request_id, result):
+            with send_lock:
+                try:
+                    conn.send((request_id, result))
+                except OSError:
+                    pass  # Client went away, nothing to deliver to
+
+        try:
+            while True:
+                request_id, fen, depth = conn.recv()
+                self.submit(reply, request_id, fen, depth)
+        except (EOFError, OSError):
+            conn.close()
+
+    def submit(self, reply, request_id, fen, depth):
+        key = (fen, depth)
+        with self.lock:
+            self.counts["requests"] += 1
+            if key in self.cache:
+                self.counts["cached"] += 1
+                self.cache.move_to_end(key)
+                result = self.cache[key]
+            elif key in self.waiting:
+                self.counts["coalesced"] += 1
+                self.waiting[key].append((reply, request_id))
+                return
+            else:
+                self.waiting[key] = [(reply, request_id)]
+                self.work.put(key)
+                return
+        reply(request_id, result)
+
+    def search(self, engine):
+        while True:
+            fen, depth = key = self.work.get()
+            try:
+                engine.set_depth(depth)
+                result = analyse(engine, fen)
+            except Exception as e:
+                result = {"error": str(e)}
+
+            with self.lock:
+                self.counts["searched"] += 1
+                waiting = self.waiting.pop(key)
+                if "error" not in result:
+                    self.cache[key] = result
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+            for reply, request_id in waiting:
+                reply(request_id, result)
+
+
+class AnalysisClient:
+    def __init__(self, address=ADDRESS, timeout=None):
+        """Connects to a running AnalysisService, raises ConnectionRefusedError if there is none or it refuses us.
+
+        Args:
+          address: (host, port) the service listens on
+          timeout: seconds analyse() waits for a result by default, None for no limit
+        """
+        try:
+            self.conn = Client(address, authkey=load_authkey())
+        except AuthenticationError as e:
+            raise ConnectionRefusedError(f"Analysis service at {address} rejected the key in {AUTHKEY_PATH}") from e
+        self.timeout = timeout
+        self.ids = itertools.count()
+        self.pending = {}
+        self.closed = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def submit(self, fen, depth=DEPTH):
+        """Requests an analysis, returns a Future for its result, raises ConnectionError once the service is gone."""
+        future = Future()
+        with self.lock:
+            # Nothing would ever answer a request sent now, the first send to a dead socket still succeeds
+            if self.closed:
+                raise ConnectionError("Analysis service closed the connection")
+            request_id = next(self.ids)
+            try:
+                self.conn.send((request_id, fen, depth))
+            except OSError as e:
+                raise ConnectionError("Analysis service closed the connection") from e
+            self.pending[request_id] = future
+        return future
+
+    def analyse(self, fen, depth=DEPTH, timeout=None):
+        """Returns the analysis of a position, raises TimeoutError after timeout seconds, self.timeout if None."""
+        future = self.submit(fen, depth)
+        try:
+            result = future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            # Before Python 3.11 not the builtin TimeoutError
+            with self.lock:
+                self.pending = {i: f for i, f in self.pending.items() if f is not future}
+            raise
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result
+
+    def receive(self):
+        try:
+            while True:
+                request_id, result = self.conn.recv()
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result(result)
+        except (EOFError, OSError):
+            with self.lock:
+                self.closed = True
+                for future in self.pending.values():
+                    future.set_exception(ConnectionError("Analysis service closed the connection"))
+                self.pending.clear()
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared Stockfish analysis service for the chess GUI.")
+    parser.add_argument("path", help="stockfish binary")
+    parser.add_argument("--engines", type=int, default=2, help="engine processes in the pool")
+    parser.add_argument("--port", type=int, default=ADDRESS[1])
+    parser.add_argument("--cache", type=int, default=4096, help="analysed positions kept")
+    args = parser.parse_args()
+
+    service = AnalysisService(args.path, args.engines, (ADDRESS[0], args.port), args.cache)
+    print(f"Analysing on {ADDRESS[0]}:{args.port} with {args.engines} engines")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        print(service.counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from move_detector import MoveDetector
+
+
+class StillCapture:
+    """Stands in for cv.VideoCapture, alternating between two fixed frames."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.count = 0
+
+    def set(self, prop, value):
+        return True
+
+    def read(self, image=None):
+        frame = self.frames[self.count % len(self.frames)]
+        self.count += 1
+        if image is None or image.shape != frame.shape:
+            image = np.empty_like(frame)
+        np.copyto(image, frame)
+        return True, image
+
+
+class BenchDetector(MoveDetector):
+    """MoveDetector with a fixed 100px grid instead of camera calibration."""
+
+    def calibrate(self):
+        boxes = {}
+        for col, c in enumerate("ABCDEFGH"):
+            for row in range(8):
+                x = 560 + col * 100
+                y = 140 + row * 100
+                boxes[c + str(row + 1)] = ([x + 100, y + 100], [x, y + 100], [x + 100, y], [x, y])
+        return boxes
+
+
+def make_frames(width=1920, height=1080):
+    rng = np.random.default_rng(0)
+    before = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    after = before.copy()
+    after[160:220, 580:640] = 255
+    after[760:820, 1280:1340] = 0
+    return [before, after]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure allocations and latency of steady-state move detection.")
+    parser.add_argument("--moves", type=int, default=200, help="detections to run after warm-up")
+    parser.add_argument("--levels", type=int, default=1, help="image pyramid levels")
+    parser.add_argument("--color", action="store_true", help="difference BGR frames instead of grayscale")
+    parser.add_argument("--threshold", type=int, default=64 * 1024, help="bytes counted as a large allocation")
+    args = parser.parse_args()
+
+    detector = BenchDetector(StillCapture(make_frames()), levels=args.levels, grayscale=not args.color)
+
+    # Warm-up allocates the frame, stage, position and diff buffers once
+    for _ in range(2):
+        detector.takePicture()
+        detector.detectPiece()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    start = perf_counter()
+    for _ in range(args.moves):
+        detector.takePicture()
+        squares = detector.detectPiece()
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    large = [stat for stat in after.compare_to(before, "lineno") if stat.size_diff >= args.threshold]
+
+    print(f"detection image:   {detector.currentPos.shape} ({detector.currentPos.nbytes} bytes)")
+    print(f"moves:             {args.moves}")
+    print(f"last detection:    {squares}")
+    print(f"mean latency:      {1000 * elapsed / args.moves:.3f} ms")
+    print(f"peak transient:    {peak - base} bytes")
+    print(f"retained growth:   {len(large)} sites over {args.threshold} bytes")
+    for stat in large:
+        print(f"  {stat}")
+    if peak - base >= args.threshold or large:
+        print("FAIL: large per-move allocations in steady state")
+        return 1
+    print("OK: no large per-move allocations in steady state")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
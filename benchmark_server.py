@@ -0,0 +1,198 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import threading
+import urllib.request
+from time import perf_counter, process_time, sleep
+
+import numpy as np
+
+from classes import EvaluationHistory
+
+BASELINE_PATH = "benchmark_server.json"
+# A p95 latency or CPU per request above this multiple of the baseline is a regression
+REGRESSION_TOLERANCE = 1.5
+
+# What the dashboard page posts every time its interval fires
+UPDATE_LAYOUT = {"output": "..cp-chart.figure...move-table.data..",
+                 "outputs": [{"id": "cp-chart", "property": "figure"}, {"id": "move-table", "property": "data"}],
+                 "inputs": [{"id": "interval-component", "property": "n_intervals", "value": 1}],
+                 "changedPropIds": ["interval-component.n_intervals"], "state": []}
+
+
+def rss_bytes():
+    """Returns the resident memory of this process, or its peak where the current value is unavailable."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def serve(history_path, port):
+    """Runs the dashboard with an extra route reporting the server's CPU time and memory."""
+    import flask
+    from server import create_app
+
+    app = create_app(history_path)
+
+    @app.server.route("/bench/usage")
+    def usage():
+        return flask.jsonify({"cpu": process_time(), "rss": rss_bytes()})
+
+    app.run_server(host="127.0.0.1", port=port)
+
+
+def get_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+
+def write_history(path, length):
+    """Writes a game of length evaluated moves to path, replacing it in one step."""
+    rng = np.random.default_rng(length)
+    history = EvaluationHistory(None, capacity=max(1, length))
+    for mc in range(length):
+        history.append(mc % 2, mc, "e2e4", "d2d4", [500, 300, 200], 300000 - 100 * mc,
+                       cp=float(rng.normal(0, 150)), elapse=int(rng.integers(500, 60000)))
+    tmp = path + ".tmp"
+    history.records[:length].tofile(tmp)
+    os.replace(tmp, path)
+    history.path = path
+    history.save_stats()
+
+
+def run_level(url, clients, requests):
+    """Has clients threads post requests update_layout calls each, back to back.
+
+    Returns:
+      latencies in ms, server CPU ms per request, peak server memory above idle per client in bytes
+    """
+    body = json.dumps(UPDATE_LAYOUT).encode()
+    latencies = [[] for _ in range(clients)]
+    errors = []
+
+    def client(out):
+        for _ in range(requests):
+            request = urllib.request.Request(url + "/_dash-update-component", data=body,
+                                             headers={"Content-Type": "application/json"})
+            start = perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+            except OSError as e:
+                errors.append(e)
+                continue
+            out.append(1000 * (perf_counter() - start))
+
+    before = get_json(url + "/bench/usage")
+    peak = before["rss"]
+    threads = [threading.Thread(target=client, args=(out,)) for out in latencies]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        peak = max(peak, get_json(url + "/bench/usage")["rss"])
+        sleep(0.05)
+    after = get_json(url + "/bench/usage")
+    if errors:
+        raise RuntimeError(f"{len(errors)} requests failed, first: {errors[0]}")
+
+    latencies = [ms for out in latencies for ms in out]
+    cpu_ms = 1000 * (after["cpu"] - before["cpu"]) / len(latencies)
+    return latencies, cpu_ms, max(0, max(peak, after["rss"]) - before["rss"]) / clients
+
+
+def load_baseline(path=BASELINE_PATH):
+    """Returns the saved results for this machine, {} if there are none."""
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f).get(platform.node(), {})
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    """Saves the results for this machine, keeping other machines'."""
+    baselines = {}
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            baselines = json.load(f)
+    baselines[platform.node()] = results
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the dashboard's update_layout callback with concurrent "
+                                                 "clients over growing evaluation histories.")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 1000, 10000], help="moves in the history")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 5, 20], help="concurrent dashboard clients")
+    parser.add_argument("--requests", type=int, default=20, help="callbacks per client")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--save", action="store_true", help="save the results as this machine's baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="file baselines are kept in")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="dashboard-bench-")
+    history_path = os.path.join(directory, "evaluation.bin")
+    write_history(history_path, 0)
+    server = multiprocessing.Process(target=serve, args=(history_path, args.port), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{args.port}"
+    for _ in range(100):
+        try:
+            get_json(url + "/bench/usage")
+            break
+        except OSError:
+            sleep(0.1)
+    else:
+        server.terminate()
+        print("FAIL: dashboard did not start")
+        return 1
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    regressions = []
+    print(f"{'moves':>6} {'clients':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'cpu ms/req':>10} "
+          f"{'mem/client':>11}")
+    try:
+        for length in args.lengths:
+            write_history(history_path, length)
+            for clients in args.clients:
+                latencies, cpu_ms, memory = run_level(url, clients, args.requests)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                key = f"{length}x{clients}"
+                results[key] = {"p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2),
+                                "cpu_ms": round(cpu_ms, 2), "memory_per_client": int(memory)}
+                print(f"{length:6d} {clients:7d} {p50:8.1f} {p95:8.1f} {p99:8.1f} {cpu_ms:10.2f} "
+                      f"{memory / 1024:8.0f} kB")
+                if key in baseline:
+                    for metric in ("p95_ms", "cpu_ms"):
+                        if results[key][metric] > REGRESSION_TOLERANCE * baseline[key][metric]:
+                            regressions.append(f"{key} {metric}: {results[key][metric]} against "
+                                               f"{baseline[key][metric]}")
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.save:
+        save_baseline(results, args.baseline)
+        print(f"Saved to {args.baseline} for {platform.node()}")
+    if not baseline:
+        print("No baseline for this machine yet, run with --save to record one")
+        return 0
+    if regressions:
+        print("FAIL: slower than the baseline")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("OK: within the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
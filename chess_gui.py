@@ -1,27 +1,42 @@
+import base64
 import copy
 import json
-import queue
 import threading
+from datetime import datetime
 
 import PySimpleGUI as sg
 import chess
 import chess.engine
 import chess.pgn
 import cv2
+import numpy as np
 from stockfish import Stockfish
 
-from classes import Timer
+from analysis_service import AnalysisClient, LocalAnalyser
+from classes import EvaluationHistory, PgnWriter, Timer, record_move
+from pipeline import DROP_NEWEST, DROP_OLDEST, Channel, Pipeline
+from recorder import SessionRecorder
+from engine_tuning import below_baseline, engine_parameters, load_config, probe_nps
+from frame_ring import FrameSource
 from move_detector import MoveDetector
 from server import init_server
 from util import *
 
+ANALYSIS_ATTEMPTS = 3  # tries at analysing a position before its move is recorded without an evaluation
+ANALYSIS_TIMEOUT = 30  # seconds waited for the analysis service before falling back to a local engine
+PIPELINE_DRAIN_TIMEOUT = 30  # seconds a finished game waits for its moves to be analysed and saved
+PIPELINE_STOP_TIMEOUT = 5
+
 
 class EasyChessGui:
-    queue = queue.Queue()
     is_p1_white = True  # White is at the bottom in board layout
+    layout_p1_white = True  # Orientation the square buttons were laid out in
 
     def __init__(self, theme):
         self.game = None
+        self.history = None
+        self.pgn = None
+        self.frame_source = None
         self.theme = theme
 
         self.init_game()
@@ -30,6 +45,13 @@ class EasyChessGui:
 
         self.psg_board = None
         self.menu_elem = None
+        self.square_state = {}  # button key -> (color, piece) it shows
+
+        # Read once, square updates only pass the data
+        self.piece_images = {}
+        for piece, path in images.items():
+            with open(path, "rb") as f:
+                self.piece_images[piece] = base64.b64encode(f.read())
 
         self.username = "P1"
         self.opp_id_name = "P2"
@@ -44,13 +66,9 @@ class EasyChessGui:
         self.engine_period_moves = 0
         self.engine_tc_type = "fischer"
 
-        # Default board color is brown
-        self.sq_light_color = "#F0D9B5"
-        self.sq_dark_color = "#B58863"
-
-        # Move highlight, for brown board
-        self.move_sq_light_color = "#E8E18E"
-        self.move_sq_dark_color = "#B8AF4E"
+        # Default board color is brown, with its move highlight
+        (self.sq_light_color, self.sq_dark_color, self.move_sq_light_color,
+         self.move_sq_dark_color) = BOARD_COLORS["Brown::board_color_k"]
 
         self.gui_theme = theme
         # self.bella = MoveDetector()
@@ -64,10 +82,28 @@ class EasyChessGui:
         elif sys_os == "Darwin":
             self.stockfish_path = "/opt/homebrew/bin/stockfish"
 
-        self.stockfish = Stockfish(path=self.stockfish_path)
+        # Share the engines of a running analysis_service.py, else run our own
+        self.stockfish = None
+        try:
+            self.analyser = AnalysisClient(timeout=ANALYSIS_TIMEOUT)
+            logging.info("Connected to the analysis service.")
+        except OSError:
+            self.analyser = self.local_analyser()
+
+    def local_analyser(self):
+        """Starts an engine in this process, when no analysis service is running or it stopped answering."""
+        # Threads/Hash measured fastest on this machine by engine_tuning.py
+        self.engine_config = load_config()
+        self.stockfish = Stockfish(path=self.stockfish_path, parameters=engine_parameters(self.engine_config))
+        if self.engine_config is not None:
+            nps = probe_nps(self.stockfish)
+            if below_baseline(nps, self.engine_config):
+                logging.warning(f"Engine throughput {nps} nps is below the saved baseline of "
+                                f"{self.engine_config['probe_nps']} nps")
+        return LocalAnalyser(self.stockfish)
 
     def get_move_from_to(self, user_move, move_cnt):
-        print(user_move)
+        logging.debug(f"Changed squares {user_move}", extra={"stage": "decode", "squares": user_move})
         p1 = user_move[0]
         p2 = user_move[1]
 
@@ -94,31 +130,62 @@ class EasyChessGui:
             else:
                 return p1, p2
 
-    def update_game(self, mc: int, user_move: str, time_left: int):
-        """Saves moves in the game.
+    def build_pipeline(self):
+        """
+        Split move handling into worker stages so a slow engine search never
+        holds up the GUI or the next detection:
 
-        Args:
-          mc: move count
-          user_move: user's move
-          time_left: time left
-        """
-        # Save user comment
-        evalU = self.stockfish.get_evaluation()
-        wdl = self.stockfish.get_wdl_stats()
-        best_move = self.stockfish.get_best_move()
-        self.stockfish.make_moves_from_current_position([''.join(user_move)])
-        id = "black" if (mc + 1) % 2 == 0 else "white"
-
-        evaluation_dictionary.append(
-            {"id": id, "move_count": (mc + 1) // 2 + 1, "best_move": best_move, "move": user_move, "wdl": wdl,
-             "time_left": time_left, evalU['type']: evalU['value']})
-
-    def create_new_window(self, window, flip=False):
-        """Hide current window and creates a new window."""
+        detect: camera burst and square scoring on "Moved", to the GUI thread
+        analyse: engine analysis of the position before each move
+        persist: evaluation history and PGN, results back to the GUI thread
+
+        Decoding the move and rendering stay on the GUI thread, which owns
+        the board and the window.
+
+        :return: pipeline, detections channel, results channel
+        """
+        pipeline = Pipeline()
+        detections = Channel("detections", 1, DROP_NEWEST)  # an unread detection is never replaced
+        analyses = Channel("analyses", 16)
+        results = Channel("results", 16, DROP_OLDEST)
+
+        def analyse(job):
+            # A move whose analysis keeps failing is still recorded, in order and without an evaluation,
+            # so the history, PGN and checkpoint stay in step
+            for attempt in range(1, ANALYSIS_ATTEMPTS + 1):
+                try:
+                    if self.analyser is None:
+                        self.analyser = self.local_analyser()
+                        logging.info("Analysing on a local engine.")
+                    job["analysis"] = self.analyser.analyse(job["fen"])
+                    return job
+                except Exception as e:
+                    logging.warning(f"Analysis of move {job['mc']} failed, attempt {attempt}/{ANALYSIS_ATTEMPTS}",
+                                    exc_info=True, extra={"stage": "analyse", "move": job["move"]})
+                    job["error"] = str(e) or type(e).__name__
+                    if isinstance(self.analyser, AnalysisClient):
+                        # The service is gone or hangs, the next attempt runs on an engine of our own
+                        self.analyser.close()
+                        self.analyser = None
+            job["analysis"] = None
+            return job
+
+        def persist(job):
+            result = record_move(self.history, self.pgn, job["mc"], job["move"], job["time_left"], job["elapse"],
+                                 job["analysis"])
+            result["error"] = job.get("error") if job["analysis"] is None else None
+            return result
+
+        # play_moves only sends "Moved" to an idle detect stage
+        pipeline.add("detect", lambda _: self.bella.detectMove(), Channel("captures", 1, DROP_NEWEST), detections)
+        pipeline.add("analyse", analyse, Channel("moves", 16), analyses)
+        pipeline.add("persist", persist, analyses, results)
+        return pipeline, detections, results
+
+    def create_new_window(self, window):
+        """Hide current window and creates a new window, needed to apply a theme."""
         loc = window.CurrentLocation()
         window.Hide()
-        if flip:
-            self.is_p1_white = not self.is_p1_white
 
         layout = self.build_main_layout(self.is_p1_white)
 
@@ -188,10 +255,34 @@ class EasyChessGui:
         """
         Change the color of a square based on square row and col.
         """
-        btn_sq = window.find_element(key=(row, col))
+        key = self.view_key(row, col)
+        btn_sq = window.find_element(key=key)
         is_dark_square = True if (row + col) % 2 else False
         bd_sq_color = (self.move_sq_dark_color if is_dark_square else self.move_sq_light_color)
         btn_sq.update(button_color=("white", bd_sq_color))
+        self.square_state[key] = (bd_sq_color, self.square_state[key][1])
+
+    def view_key(self, row, col):
+        """
+        Returns the key of the button showing board square row, col. Flipping
+        the board does not move the buttons, it turns which square each one
+        shows around.
+        """
+        if self.is_p1_white == self.layout_p1_white:
+            return row, col
+        return 7 - row, 7 - col
+
+    def flip_board(self, window):
+        """Shows the board from the other side, in place."""
+        self.is_p1_white = not self.is_p1_white
+        self.redraw_board(window)
+        self.update_labels_and_game_tags(window, human=self.username)
+
+    def set_board_color(self, window, name):
+        """Recolors the squares in place, name is a BOARD_COLORS entry."""
+        (self.sq_light_color, self.sq_dark_color, self.move_sq_light_color,
+         self.move_sq_dark_color) = BOARD_COLORS[name]
+        self.redraw_board(window)
 
     def relative_row(self, s, stm):
         """
@@ -223,7 +314,8 @@ class EasyChessGui:
 
     def redraw_board(self, window):
         """
-        Redraw board at start and afte a move.
+        Redraw board at start and afte a move. Only squares whose color or
+        piece changed are updated.
 
         :param window:
         :return:
@@ -231,18 +323,27 @@ class EasyChessGui:
         for i in range(8):
             for j in range(8):
                 color = self.sq_dark_color if (i + j) % 2 else self.sq_light_color
-                piece_image = images[self.psg_board[i][j]]
-                elem = window.find_element(key=(i, j))
-                elem.update(button_color=("white", color), image_filename=piece_image, )
+                piece = self.psg_board[i][j]
+                key = self.view_key(i, j)
+                shown_color, shown_piece = self.square_state[key]
+                if (color, piece) == (shown_color, shown_piece):
+                    continue
+                elem = window.find_element(key=key)
+                if piece == shown_piece:
+                    elem.update(button_color=("white", color))
+                else:
+                    elem.update(button_color=("white", color), image_data=self.piece_images[piece])
+                self.square_state[key] = (color, piece)
 
-    def render_square(self, image, key, location, label=None):
-        """Returns an RButton (Read Button) with image image"""
+    def render_square(self, piece, key, location, label=None):
+        """Returns an RButton (Read Button) with the image of piece"""
         if (location[0] + location[1]) % 2:
             color = self.sq_dark_color  # Dark square
         else:
             color = self.sq_light_color
-        return sg.RButton("", image_filename=image, size=(1, 1), border_width=0, button_color=("white", color),
-                          pad=(0, 0), key=key, )
+        self.square_state[key] = (color, piece)
+        return sg.RButton("", image_data=self.piece_images[piece], size=(1, 1), border_width=0,
+                          button_color=("white", color), pad=(0, 0), key=key, )
 
     def define_timer(self, window):
         """
@@ -256,22 +357,229 @@ class EasyChessGui:
 
         return timer
 
-    def play_game(self, window: sg.Window, board: chess.Board):
+    def load_grid(self, scale):
+        """
+        Returns the calibrated squares from boxes.json as polygons scaled
+        for the camera preview, or None if the camera is not calibrated.
+
+        :param scale: preview size / capture size
+        :return: int32 array of shape (64, 4, 2)
+        """
+        boxes_file = MoveDetector.directory + '/boxes.json'
+        if not os.path.isfile(boxes_file):
+            return None
+        with open(boxes_file, 'r') as f:
+            boxes = np.array(list(json.load(f).values()), np.float32)
+        # Corners are stored edge by edge, (c+1, r+1), (c, r+1), (c+1, r), (c, r), so 0 and 3 are opposite;
+        # swapping the last two walks around the square
+        return np.int32(boxes[:, [0, 1, 3, 2]] * scale)
+
+    def camera(self):
+        """
+        Returns the FrameSource owning the camera, starting it on first use.
+        The viewfinder and the move detector share its frames instead of
+        each opening the camera.
+        """
+        if self.frame_source is None:
+            self.frame_source = FrameSource(0, 1920, 1080)
+        return self.frame_source
+
+    def open_camera(self, fps=15, width=640):
+        """
+        Show the camera viewfinder with the calibrated grid on top. Frames
+        are the detector's, read from the shared frame ring at full
+        resolution so the grid lines up, but only fps times a second,
+        downscaled to width and sent to the window as raw PPM instead of PNG.
+
+        :param fps: preview frame rate cap
+        :param width: preview width in pixels
+        :return:
+        """
+        window_camera = sg.Window('Camera Viewfinder', [[sg.Image(key='image')]], finalize=True)
+        ring = self.camera().ring
+
+        preview = None
+        grid = None
+        while True:
+            event_camera, values_camera = window_camera.read(timeout=1000 // fps)
+            if event_camera == sg.WINDOW_CLOSED:
+                break
+            # Downscaled straight from shared memory, dropped if the capture process overwrote it meanwhile
+            seq, frame = ring.latest()
+            if frame is None:
+                continue
+            if preview is None:
+                scale = width / frame.shape[1]
+                preview = np.empty((round(frame.shape[0] * scale), width, 3), np.uint8)
+                grid = self.load_grid(scale)
+            cv2.resize(frame, (preview.shape[1], preview.shape[0]), dst=preview, interpolation=cv2.INTER_AREA)
+            if not ring.valid(seq):
+                continue
+            if grid is not None:
+                cv2.polylines(preview, grid, True, (0, 255, 0), 1)
+            window_camera['image'].update(data=cv2.imencode('.ppm', preview)[1].tobytes())
+        window_camera.close()
+
+    def save_checkpoint(self, moves, timers):
+        """
+        Save what is needed to resume the game after a crash or restart: the
+        moves with their clocks, the timers and time control, and where the
+        evaluation history, PGN and calibration are. Replaced atomically so
+        a crash never leaves half a checkpoint.
+
+        :param moves: [uci, time left, elapse] of every move
+        :param timers: p1 and p2 timers
+        :return:
+        """
+        checkpoint = {"moves": moves, "clocks": [timer.base for timer in timers],
+                      "tc": [self.human_tc_type, self.human_base_time_ms, self.human_inc_time_ms,
+                             self.human_period_moves], "history": self.history.path, "pgn": self.pgn.path,
+                      "pgn_result_offset": self.pgn.result_offset,
+                      "calibration": MoveDetector.directory + '/boxes.json'}
+        tmp = CHECKPOINT_PATH + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp, CHECKPOINT_PATH)
+
+    def load_checkpoint(self):
+        """Returns the checkpoint of an unfinished game, or None."""
+        try:
+            with open(CHECKPOINT_PATH, "r") as f:
+                checkpoint = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if not (os.path.isfile(checkpoint["history"]) and os.path.isfile(checkpoint["pgn"])):
+            return None
+        return checkpoint
+
+    def discard_checkpoint(self, checkpoint=None):
+        """Forget the unfinished game, closing its PGN as unfinished."""
+        if checkpoint is not None:
+            PgnWriter.resume(checkpoint["pgn"], checkpoint["pgn_result_offset"]).finish("*")
+            EvaluationHistory.resume(checkpoint["history"]).archive(os.path.splitext(checkpoint["pgn"])[0] + ".bin")
+        if os.path.isfile(CHECKPOINT_PATH):
+            os.remove(CHECKPOINT_PATH)
+
+    def resume_game(self, window, board, checkpoint):
+        """
+        Restore a game from its checkpoint: replay the moves on board and the
+        GUI, reopen the evaluation history and PGN, and bring the PGN up to
+        date from the history. Nothing already analysed is analysed again,
+        moves the engine had not got to are returned as pipeline jobs.
+
+        :return: history, pgn writer, analysis jobs
+        """
+        history = EvaluationHistory.resume(checkpoint["history"])
+        pgn = PgnWriter.resume(checkpoint["pgn"], checkpoint["pgn_result_offset"])
+        for record in history.records[len(pgn.board.move_stack):len(history)]:
+            pgn.add_move(record["move"].decode(), int(record["time_left"]), record["best_move"].decode(),
+                         record["wdl"].tolist(), float(record["cp"]), float(record["mate"]))
+
+        jobs = []
+        for mc, (uci, time_left, elapse) in enumerate(checkpoint["moves"]):
+            if mc >= len(history):
+                jobs.append({"mc": mc, "fen": board.fen(), "move": uci, "time_left": time_left, "elapse": elapse})
+            board.push_uci(uci)
+            self.append_movelist(window, mc, uci)
+
+        for row in range(8):
+            for col in range(8):
+                piece = board.piece_at(chess.square(col, 7 - row))
+                self.psg_board[row][col] = BLANK if piece is None else PIECE_SYMBOLS[piece.symbol()]
+        self.redraw_board(window)
+        logging.info(f"Resumed game after {len(checkpoint['moves'])} moves, {len(jobs)} to analyse")
+        return history, pgn, jobs
+
+    def append_movelist(self, window, move_cnt, move):
+        """Add a move to the move list box."""
+        if move_cnt % 2 == 0:
+            window.find_element("_movelist_").update(f"{(move_cnt + 1) // 2 + 1}. ", append=True)
+        window.find_element("_movelist_").update(disabled=False)
+        window.find_element("_movelist_").update(f"{move} ", append=True)
+        if move_cnt % 2 == 1:
+            window.find_element("_movelist_").update("\n", append=True)
+
+    def play_game(self, window: sg.Window, board: chess.Board, checkpoint: dict = None):
         """Play a game against an engine or human.
 
         Args:
           window: A PySimplegUI window.
           board: current board position
+          checkpoint: unfinished game to resume, from load_checkpoint
         """
         window.find_element("_movelist_").update(disabled=False)
         window.find_element("_movelist_").update("", disabled=True)
 
-        move_cnt = 0
+        if checkpoint is None:
+            white, black = (self.username, self.opp_id_name) if self.is_p1_white else (self.opp_id_name,
+                                                                                       self.username)
+            self.pgn = PgnWriter(f"output/games/{datetime.now():%Y%m%d-%H%M%S}.pgn", white, black)
+            self.history = EvaluationHistory("evaluation.bin")
+            moves, clocks, jobs = [], None, []
+        else:
+            (self.human_tc_type, self.human_base_time_ms, self.human_inc_time_ms,
+             self.human_period_moves) = checkpoint["tc"]
+            self.history, self.pgn, jobs = self.resume_game(window, board, checkpoint)
+            moves, clocks = checkpoint["moves"], checkpoint["clocks"]
+        self.game = self.pgn.game
+
+        pipeline, detections, results = self.build_pipeline()
+        pipeline.start()
+        try:
+            for job in jobs:
+                pipeline.stages[1].inbox.put(job)
+            user_quit, interrupted = self.play_moves(window, board, pipeline, detections, results, moves, clocks)
+        finally:
+            # Everything already detected still goes into the history and PGN, unless a stage is stuck on
+            # the engine or the camera
+            stuck = pipeline.drain(PIPELINE_DRAIN_TIMEOUT)
+            pipeline.stop(PIPELINE_STOP_TIMEOUT)
+            logging.info("Pipeline stopped", extra={"pipeline": pipeline.stats()})
+        if stuck:
+            # The checkpoint has every move, resuming analyses those the history is missing
+            logging.error(f"Pipeline did not drain in {PIPELINE_DRAIN_TIMEOUT} s, keeping the game resumable",
+                          extra={"stages": [stage.name for stage in stuck]})
+            interrupted = True
+
+        # Closing the window mid-game keeps it resumable
+        if not interrupted:
+            self.pgn.finish()
+            # Kept next to the PGN for the dashboard's export, the next game truncates evaluation.bin
+            self.history.archive(os.path.splitext(self.pgn.path)[0] + ".bin")
+            self.discard_checkpoint()
+
+        if board.is_game_over(claim_draw=True):
+            sg.Popup("Game is over.", title=BOX_TITLE)
+
+        if not user_quit:
+            self.clear_elements(window)
+        return user_quit
+
+    def play_moves(self, window, board, pipeline, detections, results, moves, clocks=None):
+        """
+        GUI side of play_game: reads the window, sends "Moved" presses to the
+        detect stage, decodes detections, updates the board and clock and
+        hands each move on for analysis. A checkpoint is saved after every
+        move.
+
+        :param moves: moves played so far, appended to
+        :param clocks: p1 and p2 base times when resuming
+        :return: True if the user quit, True if the window was closed
+        """
+        detect, analyse = pipeline.stages[:2]
+        move_cnt = len(moves)
 
         # Init timer
         p1_timer = self.define_timer(window)
         p2_timer = self.define_timer(window)
+        if clocks is not None:
+            p1_timer.base, p2_timer.base = clocks
+            p1_key, p2_key = ("w_base_time_k", "b_base_time_k") if self.is_p1_white else ("b_base_time_k",
+                                                                                          "w_base_time_k")
+            window.Element(p1_key).update(self.get_time_h_mm_ss(p1_timer.base))
+            window.Element(p2_key).update(self.get_time_h_mm_ss(p2_timer.base))
         user_quit = False
+        interrupted = False
 
         # Game loop
         while not board.is_game_over(claim_draw=True):
@@ -296,6 +604,7 @@ class EasyChessGui:
 
                 if button is None:
                     user_quit = True
+                    interrupted = True
                     logging.info("Quit app from main loop, X is pressed.")
                     break
 
@@ -304,11 +613,29 @@ class EasyChessGui:
                 window.Element(k1).update(elapse_str)
                 timer.elapse += 100
 
-                if button == "_moved_":
-                    self.bella.takePicture()
-                    user_move = self.bella.detectPiece()
+                # Presses while a detection is running are ignored, a second one would compare the
+                # frame after the move with itself and find noise
+                if button == "_moved_" and detect.idle():
+                    detect.inbox.put(move_cnt)
+
+                result = results.poll()
+                if result is not None and result["error"] is not None:
+                    sg.Popup(f"Engine analysis failed: {result['error']}\n"
+                             f"The game is saved and can be resumed once the engine is back.", title=BOX_TITLE)
+                    user_quit = True
+                    interrupted = True
+                    break
+                if result is not None and result["mate"] == -1:
+                    sg.Popup("Game is over. Checkmate.", title=BOX_TITLE)
+                    user_quit = True
+                    break
+
+                detection = detections.poll()
+                if detection is not None:
+                    user_move, margin = detection
                     move_from, move_to = self.get_move_from_to(user_move, move_cnt)
-                    print(f"move_from: {move_from}, move_to: {move_to}")
+                    logging.info(f"Detected {move_from}{move_to}",
+                                 extra={"stage": "decode", "move": move_from + move_to, "margin": round(margin, 3)})
                     if move_from is not None and move_to is not None and move_from != move_to:
                         break
 
@@ -330,25 +657,24 @@ class EasyChessGui:
             self.redraw_board(window)
 
             # Update clock, reset elapse to zero
+            elapse = timer.elapse
             timer.update_base()
 
-            # Update game, move from human
+            # Update game, move from human. Analysis and saving run on the pipeline.
             time_left = timer.base
-            self.update_game(move_cnt, move_from + move_to, time_left)
-            save_to_json_file("evaluation.json", evaluation_dictionary)
-            last_move = evaluation_dictionary[-1]
-            if 'mate' in last_move:
-                if last_move['mate'] == -1:
-                    sg.Popup("Game is over. Checkmate.", title=BOX_TITLE)
-                    user_quit = True
-                    break
-
-            if move_cnt % 2 == 0:
-                window.find_element("_movelist_").update(f"{(move_cnt + 1) // 2 + 1}. ", append=True)
-            window.find_element("_movelist_").update(disabled=False)
-            window.find_element("_movelist_").update(f"{user_move} ", append=True)
-            if move_cnt % 2 == 1:
-                window.find_element("_movelist_").update("\n", append=True)
+            move = chess.Move.from_uci(move_from + move_to)
+            if move not in board.legal_moves:
+                raise ValueError(f"Cannot make move: {move}")
+            fen = board.fen()
+            board.push(move)
+            moves.append([move.uci(), time_left, elapse])
+            # Checkpoint first, so the history never holds a move the checkpoint does not
+            self.save_checkpoint(moves, (p1_timer, p2_timer))
+            analyse.inbox.put({"mc": move_cnt, "fen": fen, "move": move.uci(), "time_left": time_left,
+                               "elapse": elapse})
+            logging.debug("Pipeline", extra={"pipeline": pipeline.stats()})
+
+            self.append_movelist(window, move_cnt, move.uci())
 
             # Change the color of the "fr" and "to" board squares
             self.change_square_color(window, fr_row, fr_col)
@@ -364,12 +690,7 @@ class EasyChessGui:
 
             move_cnt += 1
 
-        if board.is_game_over(claim_draw=True):
-            sg.Popup("Game is over.", title=BOX_TITLE)
-
-        if not user_quit:
-            self.clear_elements(window)
-        return user_quit
+        return user_quit, interrupted
 
     def create_board(self, is_p1_white=True):
         """
@@ -380,7 +701,11 @@ class EasyChessGui:
         :return: board layout
         """
         file_char_name = "abcdefgh"
-        self.psg_board = copy.deepcopy(initial_board)
+        # A rebuilt window shows the position it replaces
+        if self.psg_board is None:
+            self.psg_board = copy.deepcopy(initial_board)
+        self.layout_p1_white = is_p1_white
+        self.square_state = {}
 
         board_layout = []
 
@@ -400,8 +725,7 @@ class EasyChessGui:
             # Row numbers at left of board is blank
             row = []
             for j in range(start, end, step):
-                piece_image = images[self.psg_board[i][j]]
-                row.append(self.render_square(piece_image, key=(i, j), location=(i, j)))
+                row.append(self.render_square(self.psg_board[i][j], key=(i, j), location=(i, j)))
             board_layout.append(row)
 
         return board_layout
@@ -467,7 +791,7 @@ class EasyChessGui:
 
         :return:
         """
-        layout = self.build_main_layout(True)
+        layout = self.build_main_layout(self.is_p1_white)
 
         # Use white layout as default window
         window = sg.Window("{} {}".format(APP_NAME, APP_VERSION), layout, default_button_element_size=(12, 1),
@@ -564,77 +888,47 @@ class EasyChessGui:
                 window = self.create_new_window(window)
                 continue
 
-            # Mode: Neutral, Change board to gray
-            if button == "Gray::board_color_k":
-                self.sq_light_color = "#D8D8D8"
-                self.sq_dark_color = "#808080"
-                self.move_sq_light_color = "#e0e0ad"
-                self.move_sq_dark_color = "#999966"
-                self.redraw_board(window)
-                window = self.create_new_window(window)
-                continue
-
-            # Mode: Neutral, Change board to green
-            if button == "Green::board_color_k":
-                self.sq_light_color = "#daf1e3"
-                self.sq_dark_color = "#3a7859"
-                self.move_sq_light_color = "#bae58f"
-                self.move_sq_dark_color = "#6fbc55"
-                self.redraw_board(window)
-                window = self.create_new_window(window)
-                continue
-
-            # Mode: Neutral, Change board to blue
-            if button == "Blue::board_color_k":
-                self.sq_light_color = "#b9d6e8"
-                self.sq_dark_color = "#4790c0"
-                self.move_sq_light_color = "#d2e4ba"
-                self.move_sq_dark_color = "#91bc9c"
-                self.redraw_board(window)
-                window = self.create_new_window(window)
-                continue
-
-            # Mode: Neutral, Change board to brown, default
-            if button == "Brown::board_color_k":
-                self.sq_light_color = "#F0D9B5"
-                self.sq_dark_color = "#B58863"
-                self.move_sq_light_color = "#E8E18E"
-                self.move_sq_dark_color = "#B8AF4E"
-                self.redraw_board(window)
-                window = self.create_new_window(window)
+            # Mode: Neutral, Change board color
+            if button in BOARD_COLORS:
+                self.set_board_color(window, button)
                 continue
 
             # Mode: Neutral
             if button == "Flip":
                 window.find_element("_gamestatus_").update("Mode     Neutral")
                 self.clear_elements(window)
-                window = self.create_new_window(window, True)
+                self.flip_board(window)
                 continue
 
             if button == 'Open Camera':
-                layout = [[sg.Image(filename='', key='image')]]
-                window_camera = sg.Window('Camera Viewfinder', layout, size=(640, 480))
-                cap = cv2.VideoCapture(0)
-                while True:
-                    event_camera, values_camera = window_camera.read(timeout=1)
-                    if event_camera == sg.WINDOW_CLOSED:
-                        break
-                    ret, frame = cap.read()
-                    imgbytes = cv2.imencode('.png', frame)[1].tobytes()
-                    window_camera['image'].update(data=imgbytes)
-                window_camera.close()
-                cap.release()
+                try:
+                    self.open_camera()
+                except OSError:
+                    sg.Popup("Camera not found.", title=BOX_TITLE)
 
             # Mode: Neutral
             if button == "Play":
                 # Change menu from Neutral to Play
+                recorder = None
                 try:
-                    sg.PopupOK("Calibrating camera, please put above an empty chessboard and don't move it "
-                               "afterwards.", title=BOX_TITLE)
+                    if RECORD_DETECTIONS:
+                        recorder = SessionRecorder(video_fps=RECORD_VIDEO_FPS,
+                                                   source=self.camera() if RECORD_VIDEO_FPS else None)
+                    checkpoint = self.load_checkpoint()
+                    if checkpoint is not None and sg.PopupYesNo("Resume the unfinished game?",
+                                                                title=BOX_TITLE) != "Yes":
+                        self.discard_checkpoint(checkpoint)
+                        checkpoint = None
+
+                    # A resumed game reuses the calibration it was played with
+                    if checkpoint is None or not os.path.isfile(checkpoint["calibration"]):
+                        sg.PopupOK("Calibrating camera, please put above an empty chessboard and don't move it "
+                                   "afterwards.", title=BOX_TITLE)
 
-                    self.bella = MoveDetector()
+                    self.bella = MoveDetector(self.camera().capture(), recorder=recorder)
 
-                    sg.PopupOK("Camera calibrated. Please setup the board.", title=BOX_TITLE)
+                    if checkpoint is None:
+                        sg.PopupOK("Camera calibrated. Please setup the board.", title=BOX_TITLE)
 
                     self.menu_elem.update(menu_def_play)
                     self.psg_board = copy.deepcopy(initial_board)
@@ -650,7 +944,8 @@ class EasyChessGui:
                         window.find_element("_movelist_").update("", disabled=True)
                         window.find_element("_moved_").update(visible=True)
 
-                        quit = self.play_game(window, board)
+                        quit = self.play_game(window, board, checkpoint)
+                        checkpoint = None
                         if quit:
                             break
                         window.find_element("_gamestatus_").update("Mode     Neutral")
@@ -658,13 +953,13 @@ class EasyChessGui:
                     sg.Popup("Invalid move.", title=BOX_TITLE)
                 except Exception:
                     sg.Popup("Chessboard not found.", title=BOX_TITLE)
+                finally:
+                    if recorder is not None:
+                        recorder.close()
 
         window.Close()
-
-
-def save_to_json_file(file, data):
-    with open(file, "w") as json_file:
-        json.dump(data, json_file, indent=4)
+        if self.frame_source is not None:
+            self.frame_source.close()
 
 
 def main():
@@ -1,3 +1,13 @@
+import os
+import shutil
+from datetime import datetime
+
+import chess
+import chess.engine
+import chess.pgn
+import numpy as np
+
+
 class Timer:
     def __init__(self, tc_type: str = 'fischer', base: int = 300000, inc: int = 10000, period_moves: int = 40) -> None:
         """Manages time control.
@@ -28,3 +38,389 @@ class Timer:
 
         self.base = max(0, self.base)
         self.elapse = 0
+
+
+WHITE = 0
+BLACK = 1
+
+# On-disk and in-memory record layout of EvaluationHistory. Packed and
+# little-endian so another process can memory-map the file; append new fields
+# at the end only.
+EVAL_DTYPE = np.dtype([("side", "u1"), ("move_count", "<u2"), ("move", "S5"), ("best_move", "S5"),
+                       ("wdl", "<u2", (3,)), ("time_left", "<i4"), ("cp", "<f4"), ("mate", "<f4"),
+                       ("elapse", "<i4")])
+
+# Per player aggregates kept by EvaluationHistory, one record per side. Same
+# stability rules as EVAL_DTYPE.
+STATS_DTYPE = np.dtype([("moves", "<u4"), ("best_moves", "<u4"), ("scored_moves", "<u4"), ("cp_loss", "<f8"),
+                        ("inaccuracies", "<u4"), ("mistakes", "<u4"), ("blunders", "<u4"), ("time_used", "<i8"),
+                        ("max_time_used", "<i4"), ("time_profile", "<u4", (5,))])
+
+# Centipawn loss from which a move counts as an inaccuracy, mistake, blunder
+INACCURACY_CP = 50
+MISTAKE_CP = 100
+BLUNDER_CP = 300
+# Evaluations are clipped to this, and mates scored as it, before taking losses
+MAX_CP = 1000
+# Upper bounds in ms of the time_profile buckets, the last bucket is open
+TIME_PROFILE_MS = (5000, 15000, 30000, 60000)
+
+
+class EvaluationHistory:
+    def __init__(self, path: str = None, capacity: int = 128) -> None:
+        """Columnar store of per-move evaluations.
+
+        Records live in a structured array that doubles in size when full.
+        When a path is given, each record is also appended to that file as raw
+        EVAL_DTYPE bytes so the dashboard can memory-map it with open().
+
+        Per player statistics (STATS_DTYPE) are updated on every append and
+        rewritten next to the records, so readers never rescan the game.
+
+        Args:
+          path: file the records are appended to, replaced by an empty one on creation
+          capacity: initial number of records
+        """
+        self.path = path
+        self.records = np.zeros(capacity, EVAL_DTYPE)
+        self.size = 0
+        self.stats = np.zeros(2, STATS_DTYPE)
+        if self.path is not None:
+            self.save_records()
+            self.save_stats()
+
+    @classmethod
+    def open(cls, path: str) -> "EvaluationHistory":
+        """Memory-maps a history file written by another process, read-only."""
+        history = cls.__new__(cls)
+        history.path = None
+        history.size = os.path.getsize(path) // EVAL_DTYPE.itemsize
+        if history.size:
+            history.records = np.memmap(path, dtype=EVAL_DTYPE, mode="r", shape=(history.size,))
+        else:
+            history.records = np.zeros(0, EVAL_DTYPE)
+        stats = np.fromfile(stats_path(path), STATS_DTYPE) if os.path.isfile(stats_path(path)) else []
+        history.stats = stats if len(stats) == 2 else np.zeros(2, STATS_DTYPE)
+        return history
+
+    @classmethod
+    def resume(cls, path: str) -> "EvaluationHistory":
+        """Reopens a history file for appending after a restart.
+
+        A torn trailing record is cut off and the statistics are rebuilt from
+        the records, which needs no engine.
+        """
+        size = os.path.getsize(path) // EVAL_DTYPE.itemsize
+        history = cls(None, capacity=max(128, 2 * size))
+        history.records[:size] = np.fromfile(path, EVAL_DTYPE, count=size)
+        for i in range(size):
+            history.size = i + 1
+            history.update_stats()
+        history.path = path
+        history.save_records()
+        history.save_stats()
+        return history
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, side: int, move_count: int, move: str, best_move: str, wdl, time_left: int,
+               cp: float = np.nan, mate: float = np.nan, elapse: int = 0) -> None:
+        """Appends one evaluation.
+
+        Args:
+          side: WHITE or BLACK
+          move_count: full move number
+          move: move played, in uci
+          best_move: engine best move, in uci
+          wdl: win, draw, loss per mille
+          time_left: time left in ms
+          cp: centipawn score, NaN if the engine reported a mate
+          mate: mate in n, NaN if the engine reported a centipawn score
+          elapse: time spent on the move in ms
+        """
+        if self.size == len(self.records):
+            records = np.zeros(2 * len(self.records), EVAL_DTYPE)
+            records[:self.size] = self.records
+            self.records = records
+
+        record = self.records[self.size:self.size + 1]
+        record[0] = (side, move_count, move, best_move or "", wdl or (0, 0, 0), time_left, cp, mate, elapse)
+        self.size += 1
+        self.update_stats()
+
+        if self.path is not None:
+            with open(self.path, "ab") as f:
+                f.write(record.tobytes())
+            self.save_stats()
+
+    def update_stats(self) -> None:
+        """Folds the last record into the per player statistics.
+
+        A move's centipawn loss needs the evaluation of the position after it,
+        so it is counted when the next record arrives.
+        """
+        last = self.records[self.size - 1]
+        stats = self.stats[last["side"]]
+        stats["moves"] += 1
+        stats["best_moves"] += last["move"] == last["best_move"]
+        stats["time_used"] += last["elapse"]
+        stats["max_time_used"] = max(stats["max_time_used"], last["elapse"])
+        stats["time_profile"][np.searchsorted(TIME_PROFILE_MS, last["elapse"], side="right")] += 1
+
+        if self.size < 2:
+            return
+        prev = self.records[self.size - 2]
+        before, after = eval_cp(prev), eval_cp(last)
+        if np.isnan(before) or np.isnan(after):
+            return
+        # Scores are from white's point of view
+        loss = max(0.0, before - after if prev["side"] == WHITE else after - before)
+        stats = self.stats[prev["side"]]
+        stats["scored_moves"] += 1
+        stats["cp_loss"] += loss
+        if loss >= BLUNDER_CP:
+            stats["blunders"] += 1
+        elif loss >= MISTAKE_CP:
+            stats["mistakes"] += 1
+        elif loss >= INACCURACY_CP:
+            stats["inaccuracies"] += 1
+
+    def save_records(self) -> None:
+        """Replaces the records file with the records held, never truncating a file readers may have mapped."""
+        tmp = self.path + ".tmp"
+        self.records[:self.size].tofile(tmp)
+        os.replace(tmp, self.path)
+
+    def save_stats(self) -> None:
+        """Replaces the statistics file, atomically so readers never see half of it."""
+        tmp = stats_path(self.path) + ".tmp"
+        self.stats.tofile(tmp)
+        os.replace(tmp, stats_path(self.path))
+
+    def archive(self, path: str) -> None:
+        """Copies the records and statistics to path, so they outlive the next game reusing this file."""
+        shutil.copyfile(self.path, path)
+        shutil.copyfile(stats_path(self.path), stats_path(path))
+
+    def column(self, name: str) -> np.ndarray:
+        """Returns a view of one field over the recorded moves."""
+        return self.records[name][:self.size]
+
+    def side(self, side: int) -> np.ndarray:
+        """Returns a view of the records of one side, white moves first."""
+        return self.records[side:self.size:2]
+
+    def last(self) -> np.void:
+        return self.records[self.size - 1]
+
+    def rows(self) -> list:
+        """Returns the records as dicts for the dashboard table."""
+        rows = []
+        for r in self.records[:self.size]:
+            rows.append({"id": "black" if r["side"] == BLACK else "white", "move_count": int(r["move_count"]),
+                         "move": r["move"].decode(), "best_move": r["best_move"].decode(),
+                         "wdl": r["wdl"].tolist(), "time_left": int(r["time_left"]),
+                         "cp": None if np.isnan(r["cp"]) else int(r["cp"]),
+                         "mate": None if np.isnan(r["mate"]) else int(r["mate"]), "elapse": int(r["elapse"])})
+        return rows
+
+    def summary(self) -> list:
+        """Returns the per player statistics as dicts for the dashboard."""
+        rows = []
+        for side, name in ((WHITE, "white"), (BLACK, "black")):
+            s = self.stats[side]
+            moves = max(1, int(s["moves"]))
+            rows.append({"id": name, "moves": int(s["moves"]),
+                         "acpl": round(float(s["cp_loss"]) / max(1, int(s["scored_moves"])), 1),
+                         "inaccuracies": int(s["inaccuracies"]), "mistakes": int(s["mistakes"]),
+                         "blunders": int(s["blunders"]), "best_move_rate": round(100 * int(s["best_moves"]) / moves, 1),
+                         "avg_time": round(int(s["time_used"]) / moves / 1000, 1),
+                         "max_time": round(int(s["max_time_used"]) / 1000, 1),
+                         "time_profile": s["time_profile"].tolist()})
+        return rows
+
+
+def stats_path(path: str) -> str:
+    """Returns the statistics file kept next to a history file."""
+    return os.path.splitext(path)[0] + "_stats.bin"
+
+
+def eval_cp(record: np.void) -> float:
+    """Returns a record's evaluation in centipawns, clipped to MAX_CP, mates as +-MAX_CP."""
+    if not np.isnan(record["cp"]):
+        return float(np.clip(record["cp"], -MAX_CP, MAX_CP))
+    if record["mate"] > 0:
+        return MAX_CP
+    if record["mate"] < 0:
+        return -MAX_CP
+    return np.nan
+
+
+class PgnWriter:
+    def __init__(self, path: str, white: str = "?", black: str = "?", event: str = "ELEC3442 Chess") -> None:
+        """Streams an annotated PGN of a live game to disk.
+
+        Headers are written up front and every move is appended and fsynced as
+        it is played, so a crash loses at most the move in progress and the
+        file stays readable. Each move carries a [%clk] comment with the best
+        move and WDL, and the previous move gets its [%eval] once the position
+        after it has been evaluated. The same annotations are kept on game.
+
+        Args:
+          path: PGN file, overwritten
+          white: white player name
+          black: black player name
+          event: Event tag
+        """
+        self.path = path
+        self.board = chess.Board()
+        self.game = chess.pgn.Game()
+        self.game.headers["Event"] = event
+        self.game.headers["Date"] = datetime.now().strftime("%Y.%m.%d")
+        self.game.headers["White"] = white
+        self.game.headers["Black"] = black
+        self.node = self.game
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tags = "".join(f'[{k} "{v}"]\n' for k, v in self.game.headers.items() if k != "Result")
+        with open(self.path, "wb") as f:
+            f.write(tags.encode())
+            self.result_offset = f.tell()
+            # Padded so finish() can overwrite it in place with the longest result, 1/2-1/2
+            f.write(('[Result "*"]' + " " * 6 + "\n\n").encode())
+
+    @classmethod
+    def resume(cls, path: str, result_offset: int) -> "PgnWriter":
+        """Reopens an unfinished PGN written by a PgnWriter, to continue the game."""
+        writer = cls.__new__(cls)
+        writer.path = path
+        writer.result_offset = result_offset
+        with open(path, "r") as f:
+            writer.game = chess.pgn.read_game(f)
+        writer.node = writer.game.end()
+        writer.board = writer.node.board()
+        return writer
+
+    def add_move(self, uci: str, clock_ms: int, best_move: str = None, wdl=None, cp: float = np.nan,
+                 mate: float = np.nan) -> None:
+        """Appends a move.
+
+        Args:
+          uci: move played
+          clock_ms: mover's time left after the move in ms
+          best_move: engine best move in the position before the move, in uci
+          wdl: win, draw, loss per mille in the position before the move
+          cp: centipawn score of the position before the move, white's view
+          mate: mate in n of the position before the move, white's view
+        """
+        text = ""
+        score = pov_score(cp, mate)
+        if self.node is not self.game and score is not None:
+            self.node.set_eval(score)
+            text += f"{{[%eval {format_eval(score)}]}}\n"
+
+        move = chess.Move.from_uci(uci)
+        number = self.board.fullmove_number
+        if not self.board.is_legal(move):
+            # Keep the detection on record without breaking the movetext
+            self.write(text + f"{{detected {uci}, not legal in this position}}\n")
+            return
+
+        san = self.board.san(move)
+        self.board.push(move)
+        self.node = self.node.add_variation(move)
+
+        notes = []
+        if best_move:
+            notes.append(f"best {best_move}")
+        if wdl:
+            notes.append("wdl " + "/".join(str(w) for w in wdl))
+        self.node.comment = " ".join(notes)
+        self.node.set_clock(clock_ms / 1000)
+
+        dots = "." if self.board.turn == chess.BLACK else "..."
+        clock = f"[%clk {format_clock(clock_ms)}]"
+        text += f"{number}{dots} {san} {{{' '.join([clock] + notes)}}}\n"
+        self.write(text)
+
+    def finish(self, result: str = None) -> str:
+        """Appends the game termination and fills in the Result tag.
+
+        Args:
+          result: 1-0, 0-1, 1/2-1/2 or *, by default taken from the position
+
+        Returns:
+          the result
+        """
+        result = result or self.board.result(claim_draw=True)
+        self.game.headers["Result"] = result
+        self.write(f"{result}\n")
+        with open(self.path, "r+b") as f:
+            f.seek(self.result_offset)
+            f.write(f'[Result "{result}"]'.ljust(18).encode())
+        return result
+
+    def write(self, text: str) -> None:
+        with open(self.path, "ab") as f:
+            f.write(text.encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def record_move(history: EvaluationHistory, pgn: PgnWriter, mc: int, move: str, time_left: int, elapse: int,
+                analysis: dict) -> dict:
+    """Records a played move in the evaluation history and the PGN.
+
+    Args:
+      history: history of the game
+      pgn: PGN of the game
+      mc: move count, 0 for white's first move
+      move: move played, in UCI
+      time_left: mover's clock after the move in ms
+      elapse: time spent on the move in ms
+      analysis: eval, wdl and best_move of the position before the move, None if it could not be analysed
+
+    Returns:
+      dict with the move count and the mate score, NaN when there is none
+    """
+    side = BLACK if (mc + 1) % 2 == 0 else WHITE
+    if analysis is None:
+        # Still recorded, so later moves keep their place, with NaN scores and no best move or WDL
+        cp = mate = np.nan
+        best_move, wdl = "", None
+    else:
+        evaluation = analysis['eval']
+        cp = evaluation['value'] if evaluation['type'] == 'cp' else np.nan
+        mate = evaluation['value'] if evaluation['type'] == 'mate' else np.nan
+        best_move, wdl = analysis['best_move'], analysis['wdl']
+
+    history.append(side, (mc + 1) // 2 + 1, move, best_move, [0, 0, 0] if wdl is None else wdl, time_left, cp=cp,
+                   mate=mate, elapse=elapse)
+    pgn.add_move(move, time_left, best_move, wdl, cp, mate)
+    return {"mc": mc, "mate": mate}
+
+
+def pov_score(cp: float, mate: float):
+    """Returns an engine score from white's view, None if there is none."""
+    if not np.isnan(cp):
+        return chess.engine.PovScore(chess.engine.Cp(int(cp)), chess.WHITE)
+    if not np.isnan(mate):
+        return chess.engine.PovScore(chess.engine.Mate(int(mate)), chess.WHITE)
+    return None
+
+
+def format_eval(score: chess.engine.PovScore) -> str:
+    """Returns a score in [%eval] notation, pawns or #n from white's view."""
+    white = score.white()
+    if white.is_mate():
+        return f"#{white.mate()}"
+    return f"{white.score() / 100:.2f}"
+
+
+def format_clock(ms: int) -> str:
+    s = max(0, int(ms)) // 1000
+    return f"{s // 3600}:{s // 60 % 60:02d}:{s % 60:02d}"
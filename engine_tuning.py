@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import platform
+from time import perf_counter
+
+from stockfish import Stockfish
+
+CONFIG_PATH = "engine_config.json"
+
+# Fixed benchmark suite: opening, middlegame, tactical and endgame positions
+POSITIONS = ["rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+             "r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4",
+             "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+             "r1bq1rk1/pp2nppp/2n1p3/3pP3/2pP4/P1P2N2/2P1BPPP/R1BQK2R w KQ - 0 9",
+             "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+             "8/8/4k3/8/2p5/8/B2K4/8 w - - 0 1", ]
+
+# Throughput below this share of the saved baseline is reported as degraded
+BASELINE_TOLERANCE = 0.8
+
+
+def parse_info(info):
+    """Returns the numeric fields of a UCI info line, e.g. depth, nps, time."""
+    fields = {}
+    tokens = info.split()
+    for i, token in enumerate(tokens[:-1]):
+        if token in ("depth", "nodes", "nps", "time") and tokens[i + 1].isdigit():
+            fields[token] = int(tokens[i + 1])
+    return fields
+
+
+def measure(path, threads, hash_mb, depth):
+    """Searches every suite position to depth with one engine configuration.
+
+    Args:
+      path: stockfish binary
+      threads: engine Threads option
+      hash_mb: engine Hash option in MB
+      depth: search depth
+
+    Returns:
+      dict with the mean nps and the total wall time to depth in ms
+    """
+    engine = Stockfish(path=path, depth=depth, parameters={"Threads": threads, "Hash": hash_mb})
+    nps = []
+    elapsed = 0.0
+    for fen in POSITIONS:
+        engine.set_fen_position(fen)
+        start = perf_counter()
+        engine.get_best_move()
+        elapsed += perf_counter() - start
+        nps.append(parse_info(engine.info).get("nps", 0))
+    del engine
+    return {"threads": threads, "hash": hash_mb, "depth": depth, "nps": sum(nps) // len(nps),
+            "time_to_depth_ms": round(1000 * elapsed)}
+
+
+def probe_nps(engine, movetime=200):
+    """Returns the nps of a short search from the start position."""
+    engine.set_fen_position(POSITIONS[0])
+    engine.get_best_move_time(movetime)
+    nps = parse_info(engine.info).get("nps", 0)
+    engine.set_position()
+    return nps
+
+
+def load_config(path=CONFIG_PATH):
+    """Returns the saved benchmark result for this machine, or None."""
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f).get(platform.node())
+
+
+def save_config(result, path=CONFIG_PATH):
+    """Saves the benchmark result for this machine, keeping other machines'."""
+    configs = {}
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            configs = json.load(f)
+    configs[platform.node()] = result
+    with open(path, "w") as f:
+        json.dump(configs, f, indent=4)
+
+
+def engine_parameters(config):
+    """Returns the Stockfish parameters of a saved config, {} for defaults."""
+    if config is None:
+        return {}
+    return {"Threads": config["threads"], "Hash": config["hash"]}
+
+
+def below_baseline(nps, config, key="probe_nps"):
+    """Returns True if nps has fallen below the saved baseline."""
+    return config is not None and nps < BASELINE_TOLERANCE * config[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the fastest Stockfish Threads/Hash setting on this machine.")
+    parser.add_argument("path", help="stockfish binary")
+    parser.add_argument("--depth", type=int, default=18, help="search depth per position")
+    cpus = os.cpu_count() or 1
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=sorted({t for t in (1, 2, 4, 8) if t <= cpus} | {cpus}), help="thread counts")
+    parser.add_argument("--hash", type=int, nargs="+", default=[16, 64, 256], help="hash sizes in MB")
+    parser.add_argument("--config", default=CONFIG_PATH, help="file the best configuration is saved to")
+    args = parser.parse_args()
+
+    saved = load_config(args.config)
+    results = []
+    for threads in args.threads:
+        for hash_mb in args.hash:
+            result = measure(args.path, threads, hash_mb, args.depth)
+            results.append(result)
+            print(f"Threads {threads:3d}  Hash {hash_mb:5d} MB  {result['nps']:10d} nps  "
+                  f"{result['time_to_depth_ms']:7d} ms to depth {args.depth}")
+
+    best = min(results, key=lambda r: r["time_to_depth_ms"])
+    print(f"Best: Threads {best['threads']}, Hash {best['hash']} MB")
+
+    if saved is not None:
+        same = [r for r in results if r["threads"] == saved["threads"] and r["hash"] == saved["hash"]]
+        if same and below_baseline(same[0]["nps"], saved, "nps"):
+            print(f"Warning: {same[0]['nps']} nps is below the saved baseline of {saved['nps']} nps")
+
+    # Baseline for the quick check the app runs at startup
+    engine = Stockfish(path=args.path, parameters=engine_parameters(best))
+    best["probe_nps"] = probe_nps(engine)
+    del engine
+
+    save_config(best, args.config)
+    print(f"Saved to {args.config} for {platform.node()}")
+
+
+if __name__ == "__main__":
+    main()
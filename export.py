@@ -0,0 +1,174 @@
+import csv
+import glob
+import io
+import json
+import os
+
+import chess.pgn
+import numpy as np
+
+from classes import BLACK, WHITE, EvaluationHistory
+
+GAMES_DIR = "output/games"  # finished games, <id>.pgn with its evaluations archived as <id>.bin
+LIVE_PATH = "evaluation.bin"  # game being played
+LIVE_ID = "live"
+CHUNK = 4096  # records per chunk read from disk and sent
+
+COLUMNS = ["game", "white", "black", "side", "move_count", "move", "best_move", "win", "draw", "loss", "time_left",
+           "cp", "mate", "elapse"]
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+def read_players(pgn_path):
+    """Returns the White and Black tags of a PGN file, "?" when unknown."""
+    try:
+        with open(pgn_path, "r") as f:
+            headers = chess.pgn.read_headers(f)
+    except OSError:
+        headers = None
+    if headers is None:
+        return "?", "?"
+    return headers.get("White", "?"), headers.get("Black", "?")
+
+
+def list_games(live_pgn=None):
+    """Returns the exportable games as {id: {"path", "white", "black"}}, oldest first.
+
+    Args:
+      live_pgn: PGN of the game being played, None when no game is being played
+    """
+    games = {}
+    for path in sorted(glob.glob(os.path.join(GAMES_DIR, "*.bin"))):
+        if path.endswith("_stats.bin"):
+            continue
+        white, black = read_players(os.path.splitext(path)[0] + ".pgn")
+        games[os.path.splitext(os.path.basename(path))[0]] = {"path": path, "white": white, "black": black}
+    # Between games evaluation.bin holds the last game, which is already archived
+    if live_pgn is not None and os.path.isfile(LIVE_PATH):
+        white, black = read_players(live_pgn)
+        games[LIVE_ID] = {"path": LIVE_PATH, "white": white, "black": black}
+    return games
+
+
+def iter_chunks(games, player=None, first=None, last=None, chunk=CHUNK):
+    """Yields (game id, game, records) for the matching records, at most chunk records at a time.
+
+    Histories are memory-mapped and read a chunk at a time, so memory use
+    does not grow with the number or length of the games.
+
+    Args:
+      games: {id: game} as returned by list_games
+      player: only the moves of this player name, or of "white" or "black"
+      first: lowest move_count exported
+      last: highest move_count exported
+      chunk: records per chunk
+    """
+    for game_id, game in games.items():
+        sides = {WHITE, BLACK}
+        if player is not None:
+            sides = {side for side, name in ((WHITE, game["white"]), (BLACK, game["black"]))
+                     if player in (name, ("white", "black")[side])}
+            if not sides:
+                continue
+        try:
+            records = EvaluationHistory.open(game["path"]).records
+        except FileNotFoundError:
+            continue
+        for start in range(0, len(records), chunk):
+            block = records[start:start + chunk]
+            mask = np.isin(block["side"], list(sides))
+            if first is not None:
+                mask &= block["move_count"] >= first
+            if last is not None:
+                mask &= block["move_count"] <= last
+            if mask.any():
+                yield game_id, game, block[mask]
+
+
+def columns(game_id, game, records):
+    """Returns the export columns of a chunk as lists, NaN evaluations as None."""
+    def optional(values):
+        return [None if np.isnan(v) else float(v) for v in values]
+
+    return {"game": [game_id] * len(records), "white": [game["white"]] * len(records),
+            "black": [game["black"]] * len(records),
+            "side": ["black" if side == BLACK else "white" for side in records["side"]],
+            "move_count": records["move_count"].tolist(),
+            "move": [m.decode() for m in records["move"]], "best_move": [m.decode() for m in records["best_move"]],
+            "win": records["wdl"][:, 0].tolist(), "draw": records["wdl"][:, 1].tolist(),
+            "loss": records["wdl"][:, 2].tolist(), "time_left": records["time_left"].tolist(),
+            "cp": optional(records["cp"]), "mate": optional(records["mate"]), "elapse": records["elapse"].tolist()}
+
+
+def csv_stream(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for chunk in chunks:
+        cols = columns(*chunk)
+        writer.writerows(zip(*(cols[name] for name in COLUMNS)))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def jsonl_stream(chunks):
+    for chunk in chunks:
+        cols = columns(*chunk)
+        yield "".join(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in zip(*(cols[name] for name in COLUMNS)))
+
+
+class _Sink:
+    """Write-only file collecting what pyarrow writes until it is taken."""
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def arrow_schema():
+    return pa.schema([("game", pa.string()), ("white", pa.string()), ("black", pa.string()),
+                      ("side", pa.string()), ("move_count", pa.uint16()), ("move", pa.string()),
+                      ("best_move", pa.string()), ("win", pa.uint16()), ("draw", pa.uint16()),
+                      ("loss", pa.uint16()), ("time_left", pa.int32()), ("cp", pa.float32()),
+                      ("mate", pa.float32()), ("elapse", pa.int32())])
+
+
+def arrow_stream(chunks, parquet=False):
+    """Streams the chunks as an Arrow IPC stream, or as Parquet with one row group per chunk."""
+    schema = arrow_schema()
+    sink = _Sink()
+    out = pa.PythonFile(sink, mode="w")
+    writer = pq.ParquetWriter(out, schema) if parquet else pa.ipc.new_stream(out, schema)
+    for chunk in chunks:
+        writer.write_batch(pa.RecordBatch.from_pydict(columns(*chunk), schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+# format: (mimetype, stream function, needs pyarrow)
+FORMATS = {"csv": ("text/csv", csv_stream, False), "jsonl": ("application/x-ndjson", jsonl_stream, False),
+           "arrow": ("application/vnd.apache.arrow.stream", arrow_stream, True),
+           "parquet": ("application/vnd.apache.parquet", lambda chunks: arrow_stream(chunks, parquet=True), True)}
@@ -0,0 +1,263 @@
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter, sleep
+
+import cv2 as cv
+import numpy as np
+
+# Header: slots, height, width, channels (0 for single channel), latest sequence number
+HEADER = 5
+LATEST = 4
+START_TIMEOUT = 10.0  # seconds the capture process has to open the camera
+RETRY_DELAY = 0.005  # seconds waited after a failed camera read, doubled on each further one
+MAX_RETRY_DELAY = 0.5
+
+
+class FrameRing:
+    def __init__(self, shm, owner=False):
+        """Ring of frames in shared memory with one writer and any number of readers.
+
+        Every slot carries the sequence number of the frame in it, -1 while
+        it is being written. Readers take a zero-copy view of the latest frame
+        and check with valid() once they are done with it that the writer has
+        not started overwriting it meanwhile. A frame stays valid for
+        slots - 1 further frames.
+
+        Use create() in the capture process and attach() everywhere else.
+
+        Args:
+          shm: shared memory block laid out by create()
+          owner: whether this side writes and unlinks the block
+        """
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((HEADER,), np.int64, shm.buf)
+        slots, height, width, channels = (int(v) for v in self.header[:4])
+        self.seqs = np.ndarray((slots,), np.int64, shm.buf, offset=HEADER * 8)
+        shape = (slots, height, width) + ((channels,) if channels else ())
+        self.frames = np.ndarray(shape, np.uint8, shm.buf, offset=(HEADER + slots) * 8)
+        self.writing = None
+
+    @classmethod
+    def create(cls, shape, slots=4):
+        """Allocates a ring for uint8 frames of shape (height, width) or (height, width, channels)."""
+        size = (HEADER + slots) * 8 + slots * int(np.prod(shape))
+        shm = SharedMemory(create=True, size=size)
+        header = np.ndarray((HEADER,), np.int64, shm.buf)
+        header[:] = (slots, shape[0], shape[1], shape[2] if len(shape) > 2 else 0, 0)
+        np.ndarray((slots,), np.int64, shm.buf, offset=HEADER * 8)[:] = 0
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Opens a ring created by another process."""
+        try:
+            shm = SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the block with this process's
+            # resource tracker, which would unlink it when this process exits
+            shm = SharedMemory(name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def shape(self):
+        return self.frames.shape[1:]
+
+    def begin(self):
+        """Returns the slot the next frame is to be written into, writer only."""
+        n = int(self.header[LATEST]) + 1
+        slot = n % len(self.seqs)
+        self.seqs[slot] = -1
+        self.writing = n
+        return self.frames[slot]
+
+    def commit(self):
+        """Publishes the frame written since begin(), writer only."""
+        n = self.writing
+        self.seqs[n % len(self.seqs)] = n
+        self.header[LATEST] = n
+        self.writing = None
+
+    def latest(self):
+        """Returns the sequence number and a view of the latest frame, (0, None) before the first one."""
+        n = int(self.header[LATEST])
+        if n == 0:
+            return 0, None
+        return n, self.frames[n % len(self.seqs)]
+
+    def valid(self, n):
+        """Whether frame n is still intact, call after reading its view."""
+        return n > 0 and self.seqs[n % len(self.seqs)] == n
+
+    def wait(self, after=0, timeout=1.0):
+        """Waits for a frame newer than after, returns its sequence number, or 0 on timeout."""
+        deadline = perf_counter() + timeout
+        while True:
+            n = int(self.header[LATEST])
+            if n > after:
+                return n
+            if perf_counter() > deadline:
+                return 0
+            sleep(0.001)
+
+    def read(self, out, after=0, timeout=1.0):
+        """Copies the first intact frame newer than after into out, returns its sequence number, or 0 on timeout."""
+        while True:
+            n = self.wait(after, timeout)
+            if n == 0:
+                return 0
+            n, view = self.latest()
+            np.copyto(out, view)
+            if self.valid(n):
+                return n
+
+    def close(self):
+        self.frames = self.seqs = self.header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def capture_frames(cam, width, height, slots, conn):
+    """
+    Capture process: owns the camera and writes every frame straight into a
+    FrameRing. Sends the ring name back on conn, then applies (prop, value)
+    settings received on it until it receives None.
+    """
+    cap = ring = None
+    try:
+        cap = cv.VideoCapture(cam)
+        cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
+        cap.set(cv.CAP_PROP_BUFFERSIZE, 1)
+        ret, frame = cap.read()
+        if ret:
+            ring = FrameRing.create(frame.shape, slots)
+    finally:
+        # Whatever happened, the parent is waiting for an answer
+        conn.send(None if ring is None else ring.name)
+        if ring is None and cap is not None:
+            cap.release()
+    if ring is None:
+        return
+    try:
+        delay = RETRY_DELAY
+        while True:
+            if conn.poll():
+                setting = conn.recv()
+                if setting is None:
+                    break
+                cap.set(*setting)
+            view = ring.begin()
+            ret, frame = cap.read(image=view)
+            if not ret:
+                # An unplugged or busy camera fails at once, do not spin on it
+                sleep(delay)
+                delay = min(2 * delay, MAX_RETRY_DELAY)
+                continue
+            delay = RETRY_DELAY
+            if frame.ctypes.data != view.ctypes.data:
+                np.copyto(view, frame)
+            ring.commit()
+    finally:
+        cap.release()
+        ring.close()
+
+
+class FrameSource:
+    def __init__(self, cam=0, width=1920, height=1080, slots=4):
+        """Starts the process owning the camera, frames are shared through a FrameRing.
+
+        The preview, the detector and recorders read the same frames
+        instead of each opening the camera, in this or any other process
+        that attaches to ring_name.
+
+        Args:
+          cam: camera index passed to cv.VideoCapture
+          width: capture width
+          height: capture height
+          slots: frames kept in the ring
+        """
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=capture_frames, args=(cam, width, height, slots, child),
+                                               name="capture", daemon=True)
+        self.process.start()
+        # Only the capture process holds its end, so its exit shows up here as EOF
+        child.close()
+        self.ring_name = None
+        deadline = perf_counter() + START_TIMEOUT
+        try:
+            while not self.conn.poll(0.1):
+                if not self.process.is_alive() or perf_counter() > deadline:
+                    break
+            else:
+                self.ring_name = self.conn.recv()
+        except EOFError:
+            pass
+        if self.ring_name is None:
+            self.process.terminate()
+            self.process.join()
+            self.conn.close()
+            raise OSError(f"Cannot read from camera {cam}")
+        self.ring = FrameRing.attach(self.ring_name)
+
+    def set(self, prop, value):
+        """Changes a camera setting other than the frame size, which the ring is fixed to."""
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return value == self.ring.shape[1]
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return value == self.ring.shape[0]
+        self.conn.send((prop, value))
+        return True
+
+    def capture(self):
+        """Returns a cv.VideoCapture stand-in reading from the ring, e.g. for MoveDetector."""
+        return RingCapture(self)
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass  # the capture process is already gone
+        self.process.join(5)
+        self.conn.close()
+        self.ring.close()
+
+
+class RingCapture:
+    def __init__(self, source):
+        """Reads a FrameSource like a cv.VideoCapture: each read waits for a frame it has not returned yet."""
+        self.source = source
+        self.last = 0
+
+    def read(self, image=None):
+        ring = self.source.ring
+        if image is None or image.shape != ring.shape:
+            image = np.empty(ring.shape, np.uint8)
+        n = ring.read(image, self.last)
+        if n == 0:
+            return False, image
+        self.last = n
+        return True, image
+
+    def set(self, prop, value):
+        return self.source.set(prop, value)
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return self.source.ring.shape[1]
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return self.source.ring.shape[0]
+        return 0
+
+    def isOpened(self):
+        return self.source.process.is_alive()
+
+    def release(self):
+        pass
@@ -6,6 +6,8 @@ import cv2 as cv
 import matplotlib.pyplot as plt
 import numpy as np
 
+READ_ATTEMPTS = 3  # camera reads tried before giving up on a frame
+
 
 class MoveDetector:
     cap = None
@@ -13,17 +15,37 @@ class MoveDetector:
     directory = "output/move_detector"
     prevPos = None
     currentPos = None
+    frame = None
+    diff = None
+    stages = []
+    scores = None
     translation = {"A": "H", "H": "A", "B": "G", "G": "B", "C": "F", "F": "C", "D": "E", "E": "D"}
 
-    def __init__(self, cam=0):
-        self.cap = cv.VideoCapture(cam)
+    def __init__(self, cam=0, levels=1, grayscale=True, margin=10, recorder=None):
+        """Opens the camera and calibrates the board.
+
+        Args:
+          cam: camera index passed to cv.VideoCapture, or an already opened
+            object with the same read/set interface
+          levels: number of image pyramid levels to downscale by before
+            differencing, each level halves the width and height. 0 keeps
+            full resolution (most accurate, slowest).
+          grayscale: difference single channel frames instead of BGR
+          margin: pixels kept around the calibrated board when cropping
+          recorder: optional SessionRecorder given every detection
+        """
+        self.cap = cam if hasattr(cam, "read") else cv.VideoCapture(cam)
         self.cap.set(3, 1920)
         self.cap.set(4, 1080)
         self.cap.set(cv.CAP_PROP_AUTO_EXPOSURE, 0)
         self.cap.set(cv.CAP_PROP_EXPOSURE, 2)
+        self.levels = levels
+        self.grayscale = grayscale
+        self.recorder = recorder
         if not os.path.isdir(self.directory):
             os.makedirs(self.directory)
         self.boxes = self.calibrate()
+        self.roi, self.detectBoxes = self.detectionGeometry(self.boxes, margin)
         return
 
     def calibrate(self):
@@ -40,7 +62,7 @@ class MoveDetector:
                 boxes = json.load(f)
                 return boxes
         else:
-            _, frame = self.cap.read()
+            frame = self.readFrame()
 
         plt.figure(figsize=(10, 10))
         plt.imshow(frame)
@@ -186,17 +208,91 @@ class MoveDetector:
 
         return boxes
 
+    def detectionGeometry(self, boxes, margin):
+        """
+        Returns the board bounding region of the full frame as (y0, y1, x0, x1)
+        and the calibrated boxes mapped into the cropped, downscaled image.
+        """
+        xs = [point[0] for box in boxes.values() for point in box]
+        ys = [point[1] for box in boxes.values() for point in box]
+        x0 = max(0, int(min(xs)) - margin)
+        y0 = max(0, int(min(ys)) - margin)
+        x1 = int(max(xs)) + margin + 1
+        y1 = int(max(ys)) + margin + 1
+
+        scale = 2 ** self.levels
+        detectBoxes = {}
+        for square, box in boxes.items():
+            detectBoxes[square] = tuple(((x - x0) / scale, (y - y0) / scale) for x, y in box)
+        return (y0, y1, x0, x1), detectBoxes
+
+    def allocateBuffers(self, frame):
+        """
+        Allocates the buffers reused by every detection: one per intermediate
+        preprocessing step, the previous and current positions and the diff.
+        """
+        y0, y1, x0, x1 = self.roi
+        crop = frame[y0:y1, x0:x1]
+        h, w = crop.shape[:2]
+        channels = () if self.grayscale else crop.shape[2:]
+
+        shapes = []
+        if self.grayscale:
+            shapes.append((h, w))
+        for _ in range(self.levels):
+            h, w = (h + 1) // 2, (w + 1) // 2
+            shapes.append((h, w) + channels)
+
+        # The last step writes straight into a position buffer
+        self.stages = [np.empty(shape, np.uint8) for shape in shapes[:-1]]
+        self.prevPos = np.zeros((h, w) + channels, np.uint8)
+        self.currentPos = np.zeros_like(self.prevPos)
+        self.diff = np.empty_like(self.prevPos)
+
+    def preprocess(self, frame, dst):
+        """Crops a frame to the board and reduces it into dst at the detection resolution."""
+        y0, y1, x0, x1 = self.roi
+        img = frame[y0:y1, x0:x1]
+        buffers = self.stages + [dst]
+        step = 0
+        if self.grayscale:
+            img = cv.cvtColor(img, cv.COLOR_BGR2GRAY, dst=buffers[step])
+            step += 1
+        for _ in range(self.levels):
+            img = cv.pyrDown(img, dst=buffers[step])
+            step += 1
+        if step == 0:
+            np.copyto(dst, img)
+        return dst
+
+    def readFrame(self, image=None):
+        """Reads a frame into image if possible, raises OSError if the camera gives none.
+
+        A failed read leaves image stale or, when just allocated, uninitialised,
+        so it is never returned.
+        """
+        for _ in range(READ_ATTEMPTS):
+            ret, frame = self.cap.read(image=image)
+            if ret:
+                return frame
+        raise OSError(f"No frame from the camera after {READ_ATTEMPTS} reads")
+
+    def capture(self):
+        """Reads a frame into the current position buffer, keeping the previous one."""
+        self.frame = self.readFrame(self.frame)
+        if self.diff is None:
+            self.allocateBuffers(self.frame)
+        self.preprocess(self.frame, self.currentPos)
+
     def takePicture(self):
-        _, frame = self.cap.read()
-        self.prevPos = self.currentPos
-        self.currentPos = frame
+        self.prevPos, self.currentPos = self.currentPos, self.prevPos
+        self.capture()
 
     def tileSum(self, bound, img):
         coords = []
         for i in bound:
             coord = (int(i[0]), int(i[1]))
             coords.append(coord)
-            cv.circle(img, center=coord, radius=5, color=(255, 0, 0), thickness=5)
 
         # print(coords[0][0], coords[3][0] , coords[0][1], coords[3][1])
         bound1 = min(coords[0][0], coords[3][0])
@@ -205,7 +301,8 @@ class MoveDetector:
         bound4 = max(coords[0][1], coords[3][1])
         tile = img[bound3:bound4, bound1:bound2]
 
-        return tile.sum()
+        # tile is a strided view, numpy's sum would buffer a converted copy of it
+        return sum(cv.sumElems(tile))
 
     def findTop2(self, boxes, img):
         values = []
@@ -216,9 +313,58 @@ class MoveDetector:
         return self.translation[values[0][1][0]].lower() + values[0][1][1], self.translation[values[1][1][0]].lower() + \
                values[1][1][1]
 
+    def squareScores(self, img, out):
+        """Writes the tile sum of every calibrated square of img into out, in boxes order."""
+        for i, box in enumerate(self.detectBoxes):
+            out[i] = self.tileSum(self.detectBoxes[box], img)
+        return out
+
     def detectPiece(self):
-        newImg = cv.absdiff(self.currentPos, self.prevPos)
-        return self.findTop2(self.boxes, newImg)
+        newImg = cv.absdiff(self.currentPos, self.prevPos, dst=self.diff)
+        squares = self.findTop2(self.detectBoxes, newImg)
+        if self.recorder is not None:
+            self.recorder.record(self.prevPos, self.currentPos, squares)
+        return squares
+
+    def detectMove(self, burst=5, minFrames=2, confidence=0.5):
+        """
+        Detects the two squares that changed since the last picture from a
+        burst of frames rather than a single one. Square scores are combined
+        with the median over the frames read so far, so a single noisy,
+        flickering or shadowed frame cannot reorder them. Reading stops early
+        once the margin is at least confidence.
+
+        The margin is how far the second square stands out from the third:
+        (second - third) / second, 0 when they are tied, 1 when nothing else
+        changed.
+
+        :param burst: maximum number of frames to read
+        :param minFrames: frames read before stopping early
+        :param confidence: margin at which to stop early
+        :return: the two squares and the margin
+        """
+        if self.scores is None or len(self.scores) < burst:
+            self.scores = np.zeros((burst, len(self.detectBoxes)))
+        self.prevPos, self.currentPos = self.currentPos, self.prevPos
+
+        for n in range(1, burst + 1):
+            self.capture()
+            cv.absdiff(self.currentPos, self.prevPos, dst=self.diff)
+            self.squareScores(self.diff, self.scores[n - 1])
+
+            combined = np.median(self.scores[:n], axis=0)
+            top = np.argsort(combined)[::-1][:3]
+            second, third = combined[top[1]], combined[top[2]]
+            margin = float((second - third) / second) if second > 0 else 0.0
+            if n >= minFrames and margin >= confidence:
+                break
+
+        boxes = list(self.detectBoxes)
+        first, second = boxes[top[0]], boxes[top[1]]
+        squares = self.translation[first[0]].lower() + first[1], self.translation[second[0]].lower() + second[1]
+        if self.recorder is not None:
+            self.recorder.record(self.prevPos, self.currentPos, squares, margin, combined)
+        return squares, margin
 
 
 def main():
@@ -0,0 +1,169 @@
+import logging
+import queue
+import threading
+from time import perf_counter
+
+# What Channel.put does when the channel is full
+BLOCK = "block"  # wait for space, slowing the producer down
+DROP_NEWEST = "drop_newest"  # discard the item being put
+DROP_OLDEST = "drop_oldest"  # discard the oldest queued item to make room
+
+_STOP = object()
+
+
+class Channel:
+    def __init__(self, name, maxsize, policy=BLOCK):
+        """Bounded queue between two pipeline stages.
+
+        Args:
+          name: name used in stats and logs
+          maxsize: number of items held before policy applies
+          policy: BLOCK, DROP_NEWEST or DROP_OLDEST
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, item):
+        """Queues item according to the policy, returns False if it was dropped."""
+        if self.policy == BLOCK:
+            self.queue.put(item)
+            return True
+        if self.policy == DROP_NEWEST:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                self.dropped += 1
+                return False
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def poll(self):
+        """Returns the next item without waiting, None if there is none."""
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            return None
+        self.queue.task_done()
+        return item
+
+    def __len__(self):
+        return self.queue.qsize()
+
+
+class Stage(threading.Thread):
+    def __init__(self, name, func, inbox, outbox=None):
+        """Worker thread applying func to every item of inbox.
+
+        Results other than None are put on outbox. Exceptions are logged and
+        the item is skipped, so one bad item does not stop the pipeline.
+
+        Args:
+          name: name used in stats and logs
+          func: called with each item
+          inbox: Channel to read from
+          outbox: Channel results are put on
+        """
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.started_at = None
+
+    def run(self):
+        self.started_at = perf_counter()
+        while True:
+            item = self.inbox.queue.get()
+            if item is _STOP:
+                self.inbox.queue.task_done()
+                break
+            start = perf_counter()
+            try:
+                result = self.func(item)
+            except Exception:
+                logging.exception(f"Stage {self.name} failed", extra={"stage": self.name})
+                self.errors += 1
+                result = None
+            ms = 1000 * (perf_counter() - start)
+            self.busy += ms
+            self.processed += 1
+            logging.debug(f"Stage {self.name} done", extra={"stage": self.name, "ms": round(ms, 2),
+                                                            "depth": len(self.inbox)})
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+            # Marked done only after the result is passed on, so draining stages in order is complete
+            self.inbox.queue.task_done()
+
+    def idle(self):
+        """Whether no item is queued or being worked on, an item counts until its result is passed on."""
+        return self.inbox.queue.unfinished_tasks == 0
+
+    def stats(self):
+        elapsed = perf_counter() - self.started_at if self.started_at else 0
+        return {"stage": self.name, "depth": len(self.inbox), "maxsize": self.inbox.maxsize,
+                "dropped": self.inbox.dropped, "processed": self.processed, "errors": self.errors,
+                "mean_ms": round(self.busy / self.processed, 2) if self.processed else 0,
+                "per_s": round(self.processed / elapsed, 3) if elapsed else 0}
+
+
+class Pipeline:
+    def __init__(self):
+        """Stages connected by channels, started, drained and stopped together."""
+        self.stages = []
+
+    def add(self, name, func, inbox, outbox=None):
+        stage = Stage(name, func, inbox, outbox)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def drain(self, timeout=None):
+        """Waits until every queued item has gone through, stages in the order they were added.
+
+        Returns the stages still holding items after timeout seconds, [] once
+        everything went through.
+        """
+        deadline = None if timeout is None else perf_counter() + timeout
+        for stage in self.stages:
+            done = stage.inbox.queue.all_tasks_done
+            with done:
+                while stage.inbox.queue.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - perf_counter()
+                    if remaining is not None and remaining <= 0:
+                        return [stage for stage in self.stages if not stage.idle()]
+                    done.wait(remaining)
+        return []
+
+    def stop(self, timeout=None):
+        """Stops the stages, returns those still running after timeout seconds, which are left to die with the app."""
+        deadline = None if timeout is None else perf_counter() + timeout
+        for stage in self.stages:
+            try:
+                # A stuck stage may leave its channel full
+                stage.inbox.queue.put(_STOP, timeout=None if deadline is None else max(0.0, deadline - perf_counter()))
+            except queue.Full:
+                pass
+        for stage in self.stages:
+            stage.join(None if deadline is None else max(0.0, deadline - perf_counter()))
+        return [stage for stage in self.stages if stage.is_alive()]
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
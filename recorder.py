@@ -0,0 +1,189 @@
+import glob
+import json
+import os
+import queue
+import threading
+from collections import deque
+from time import time
+
+import cv2 as cv
+import numpy as np
+
+
+class SessionRecorder:
+    def __init__(self, directory="output/recordings", max_bytes=200 * 1024 * 1024, slots=4, video_fps=0.0,
+                 segment_frames=600, source=None):
+        """Records what MoveDetector saw, for looking into misdetections.
+
+        Every detection is saved as a compressed .npz with the before and
+        after images at detection resolution, the squares found and, from
+        detectMove, the per square scores and margin. Optionally the whole
+        session is also written as low frame rate MJPG video in segments,
+        read from the camera's frame ring on a thread of its own. Files form
+        a ring in directory: the oldest are deleted once the total passes
+        max_bytes.
+
+        Callers only copy images into preallocated slots, compression and
+        disk I/O run on a background thread. When every slot is waiting to be
+        written the recording is dropped rather than making the caller wait.
+
+        Args:
+          directory: where recordings are kept
+          max_bytes: size of the ring on disk
+          slots: detections and video frames buffered for the writer
+          video_fps: video frame rate, 0 for no video
+          segment_frames: frames per video file
+          source: FrameSource the video is read from, no video without one
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.slots = slots
+        self.video_fps = video_fps
+        self.segment_frames = segment_frames
+        self.dropped = 0
+
+        self.queue = queue.Queue()
+        self.free_detections = queue.Queue()
+        self.free_frames = queue.Queue()
+        self.allocated_detections = 0
+        self.allocated_frames = 0
+        self.last_frame = 0.0
+
+        self.video = None
+        self.video_path = None
+        self.video_frames = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Continue the ring left by earlier sessions
+        existing = sorted(glob.glob(os.path.join(self.directory, "*.npz")) +
+                          glob.glob(os.path.join(self.directory, "*.avi")), key=os.path.getmtime)
+        self.files = deque((path, os.path.getsize(path)) for path in existing)
+        self.total = sum(size for _, size in self.files)
+        # Older files may have been evicted, so counting them would reuse a number still on disk
+        self.seq = max((file_index(path) for path in existing), default=-1) + 1
+
+        self.thread = threading.Thread(target=self.run, name="recorder", daemon=True)
+        self.thread.start()
+        self.stopping = threading.Event()
+        self.video_thread = None
+        if self.video_fps and source is not None:
+            self.video_thread = threading.Thread(target=self.record_video, args=(source,), name="recorder-video",
+                                                 daemon=True)
+            self.video_thread.start()
+
+    def slot(self, free, allocated, like):
+        """Returns a free buffer set, allocating up to self.slots of them, or None."""
+        try:
+            return free.get_nowait(), allocated
+        except queue.Empty:
+            if allocated >= self.slots:
+                return None, allocated
+            return [np.empty_like(a) for a in like], allocated + 1
+
+    def record(self, before, after, squares, margin=None, scores=None):
+        """Queues a detection: the images compared, the squares found and, if known, their margin and square scores."""
+        buffers, self.allocated_detections = self.slot(self.free_detections, self.allocated_detections,
+                                                       (before, after))
+        if buffers is None:
+            self.dropped += 1
+            return
+        np.copyto(buffers[0], before)
+        np.copyto(buffers[1], after)
+        meta = {"time": time(), "squares": list(squares), "margin": margin}
+        # A few dozen values, cheaper to copy than to pool
+        scores = np.empty(0) if scores is None else np.array(scores)
+        self.queue.put(("detection", buffers, (meta, scores)))
+
+    def add_frame(self, frame):
+        """Queues a video frame if video is on and one is due."""
+        now = time()
+        if not self.video_fps or now - self.last_frame < 1 / self.video_fps:
+            return
+        buffers, self.allocated_frames = self.slot(self.free_frames, self.allocated_frames, (frame,))
+        if buffers is None:
+            self.dropped += 1
+            return
+        self.last_frame = now
+        np.copyto(buffers[0], frame)
+        self.queue.put(("frame", buffers, {"time": now}))
+
+    def record_video(self, source):
+        """Video thread: queues the camera's latest frame every 1 / video_fps seconds until close()."""
+        capture = source.capture()
+        frame = None
+        while not self.stopping.wait(1 / self.video_fps):
+            ret, frame = capture.read(image=frame)
+            if ret:
+                self.add_frame(frame)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, buffers, meta = item
+            if kind == "detection":
+                self.write_detection(buffers, *meta)
+                self.free_detections.put(buffers)
+            else:
+                self.write_frame(buffers[0])
+                self.free_frames.put(buffers)
+        self.close_segment()
+
+    def write_detection(self, buffers, meta, scores):
+        before, after = buffers
+        path = os.path.join(self.directory, f"detection_{self.seq:06d}.npz")
+        self.seq += 1
+        np.savez_compressed(path, before=before, after=after, scores=scores, meta=json.dumps(meta))
+        self.add_file(path)
+
+    def write_frame(self, frame):
+        if self.video is None:
+            self.video_path = os.path.join(self.directory, f"video_{self.seq:06d}.avi")
+            self.seq += 1
+            h, w = frame.shape[:2]
+            self.video = cv.VideoWriter(self.video_path, cv.VideoWriter_fourcc(*"MJPG"), self.video_fps, (w, h),
+                                        isColor=frame.ndim == 3)
+            self.video_frames = 0
+        self.video.write(frame)
+        self.video_frames += 1
+        if self.video_frames >= self.segment_frames:
+            self.close_segment()
+
+    def close_segment(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+            self.add_file(self.video_path)
+
+    def add_file(self, path):
+        size = os.path.getsize(path)
+        self.files.append((path, size))
+        self.total += size
+        while self.total > self.max_bytes and len(self.files) > 1:
+            oldest, size = self.files.popleft()
+            self.total -= size
+            if os.path.isfile(oldest):
+                os.remove(oldest)
+
+    def close(self):
+        """Stops the video, writes out everything queued and closes the current video segment."""
+        self.stopping.set()
+        if self.video_thread is not None:
+            self.video_thread.join()
+        self.queue.put(None)
+        self.thread.join()
+
+
+def file_index(path):
+    """Returns the sequence number in a recording's name, e.g. 12 for detection_000012.npz."""
+    return int(os.path.splitext(os.path.basename(path))[0].rsplit("_", 1)[1])
+
+
+def load_detection(path):
+    """Returns a recorded detection as a dict of before, after, scores and its metadata."""
+    with np.load(path) as data:
+        detection = json.loads(str(data["meta"]))
+        detection.update(before=data["before"], after=data["after"], scores=data["scores"])
+    return detection
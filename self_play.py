@@ -0,0 +1,145 @@
+import argparse
+import logging
+import os
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from time import perf_counter
+
+import chess
+from stockfish import Stockfish
+
+from analysis_service import analyse
+from classes import EvaluationHistory, PgnWriter, Timer, record_move
+from util import LOG_FILE
+
+OUTPUT_DIR = "output/selfplay"
+STAGES = ("search", "analyse", "persist")
+
+
+def move_time(timer, moves_left=30):
+    """Returns the ms to think on a move: an even share of the clock plus most of the increment."""
+    return max(50, min(timer.base // 2, timer.base // moves_left + timer.inc * 4 // 5))
+
+
+def play(index, options):
+    """Plays one engine game and records it like a game on the board.
+
+    Both sides search under their own Timer, a third engine analyses the
+    position before each move for the evaluation history and PGN.
+
+    Args:
+      index: game number, seeds the random opening
+      options: dict of the command line options
+
+    Returns:
+      dict with the game's id, result, termination, plies and per stage ms
+    """
+    game_id = f"{options['run']}-{index:04d}"
+    base = os.path.join(options["output"], game_id)
+    engines = [Stockfish(path=options["path"], parameters={"Threads": 1, "Hash": options["hash"],
+                                                           "Skill Level": skill})
+               for skill in (options["white_skill"], options["black_skill"])]
+    analyser = Stockfish(path=options["path"], depth=options["analysis_depth"],
+                         parameters={"Threads": 1, "Hash": options["hash"]})
+    timers = [Timer(options["tc_type"], options["base"], options["inc"]) for _ in range(2)]
+
+    history = EvaluationHistory(base + ".bin")
+    pgn = PgnWriter(base + ".pgn", f"Stockfish skill {options['white_skill']}",
+                    f"Stockfish skill {options['black_skill']}", event="ELEC3442 Self-play")
+    board = chess.Board()
+    rng = random.Random(index)
+    stage_ms = dict.fromkeys(STAGES, 0.0)
+    result = termination = None
+
+    while result is None:
+        mc = len(board.move_stack)
+        side = mc % 2
+        timer = timers[side]
+        fen = board.fen()
+
+        start = perf_counter()
+        if mc < options["random_plies"]:
+            # Varied openings, or every game between the same engines would be the same
+            move = rng.choice(list(board.legal_moves)).uci()
+        else:
+            engines[side].set_fen_position(fen, send_ucinewgame_token=False)
+            move = engines[side].get_best_move_time(move_time(timer))
+        elapse = round(1000 * (perf_counter() - start))
+        stage_ms["search"] += elapse
+
+        start = perf_counter()
+        analysis = analyse(analyser, fen)
+        stage_ms["analyse"] += 1000 * (perf_counter() - start)
+
+        timer.elapse = elapse
+        timer.update_base()
+        board.push_uci(move)
+        start = perf_counter()
+        record_move(history, pgn, mc, move, timer.base, elapse, analysis)
+        stage_ms["persist"] += 1000 * (perf_counter() - start)
+
+        if timer.base <= 0:
+            result, termination = ("0-1", "time forfeit") if side == 0 else ("1-0", "time forfeit")
+        elif board.is_game_over(claim_draw=True):
+            result, termination = board.result(claim_draw=True), "normal"
+        elif len(board.move_stack) >= options["max_plies"]:
+            result, termination = "1/2-1/2", "adjudication"
+
+    pgn.finish(result)
+    return {"game": game_id, "result": result, "termination": termination, "plies": len(board.move_stack),
+            "stage_ms": stage_ms}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play Stockfish against itself in parallel games, recording them "
+                                                 "like games on the board, to load the analysis and storage paths.")
+    parser.add_argument("path", help="stockfish binary")
+    parser.add_argument("--games", type=int, default=8)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="games played at once")
+    parser.add_argument("--white-skill", type=int, default=20, help="Stockfish Skill Level 0-20")
+    parser.add_argument("--black-skill", type=int, default=20, help="Stockfish Skill Level 0-20")
+    parser.add_argument("--tc-type", default="fischer", choices=["fischer", "delay", "timepermove", "classical"])
+    parser.add_argument("--base", type=int, default=60000, help="base time in ms")
+    parser.add_argument("--inc", type=int, default=1000, help="increment in ms")
+    parser.add_argument("--analysis-depth", type=int, default=10, help="depth of the recorded analysis")
+    parser.add_argument("--hash", type=int, default=16, help="Hash in MB of every engine")
+    parser.add_argument("--random-plies", type=int, default=4, help="random opening plies")
+    parser.add_argument("--max-plies", type=int, default=400, help="plies after which a game is drawn")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="directory games are written to")
+    args = parser.parse_args()
+
+    options = vars(args)
+    options["run"] = f"{datetime.now():%Y%m%d-%H%M%S}"
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    results = Counter()
+    stage_ms = dict.fromkeys(STAGES, 0.0)
+    plies = 0
+    start = perf_counter()
+    with ProcessPoolExecutor(args.jobs) as pool:
+        futures = [pool.submit(play, index, options) for index in range(args.games)]
+        for future in as_completed(futures):
+            game = future.result()
+            results[game["result"]] += 1
+            plies += game["plies"]
+            for stage in STAGES:
+                stage_ms[stage] += game["stage_ms"][stage]
+            logging.info(f"Self-play game {game['game']} {game['result']}", extra=game)
+            print(f"{game['game']}: {game['result']} ({game['termination']}) in {game['plies']} plies")
+    hours = (perf_counter() - start) / 3600
+
+    print(f"games:          {args.games} in {3600 * hours:.0f} s with {args.jobs} jobs")
+    print(f"games per hour: {args.games / hours:.1f}")
+    print(f"results:        1-0 {results['1-0']}  0-1 {results['0-1']}  1/2-1/2 {results['1/2-1/2']}")
+    print(f"plies per game: {plies / args.games:.1f}, games logged to {LOG_FILE}")
+    total = sum(stage_ms.values())
+    for stage in STAGES:
+        print(f"{stage + ':':15s} {stage_ms[stage] / plies:8.1f} ms per ply  {100 * stage_ms[stage] / total:5.1f} %")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -3,19 +3,48 @@ import threading
 import webbrowser
 
 import dash
-import pandas as pd
+import flask
 from dash import dash_table
 from dash import dcc
 from dash import html
 from dash.dependencies import Input, Output
 
+import export
+from classes import BLACK, WHITE, EvaluationHistory
+from util import CHECKPOINT_PATH
 
-def init_server(host="0.0.0.0", port=8080):
+
+def live_pgn():
+    """Returns the PGN of the game being played, from its checkpoint, or None."""
+    try:
+        with open(CHECKPOINT_PATH, "r") as f:
+            return json.load(f)["pgn"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def create_app(history_path=export.LIVE_PATH):
+    """Returns the dashboard app showing the evaluation history at history_path."""
     app = dash.Dash(__name__)
 
     app.title = "ELEC3442 Chess Bot Analysis"
     app.layout = html.Div([html.H1("ELEC3442 Chess Bot Analysis", style={"textAlign": "center"}),
                            html.H6("Auto-updates every 3 seconds", style={"textAlign": "center"}),
+                           dash_table.DataTable(id="stats-table",
+                                                columns=[{"name": "Color", "id": "id"},
+                                                         {"name": "Moves", "id": "moves"},
+                                                         {"name": "Avg Centipawn Loss", "id": "acpl"},
+                                                         {"name": "Inaccuracies", "id": "inaccuracies"},
+                                                         {"name": "Mistakes", "id": "mistakes"},
+                                                         {"name": "Blunders", "id": "blunders"},
+                                                         {"name": "Best Move (%)", "id": "best_move_rate"},
+                                                         {"name": "Avg Time (s)", "id": "avg_time"},
+                                                         {"name": "Longest (s)", "id": "max_time"},
+                                                         {"name": "<5s / <15s / <30s / <60s / 60s+",
+                                                          "id": "time_profile"}, ],
+                                                style_cell={"textAlign": "center"},
+                                                style_header={"backgroundColor": "rgb(230, 230, 230)",
+                                                              "fontWeight": "bold", }, ),
                            dcc.Graph(id="cp-chart"), dash_table.DataTable(id="move-table",
                                                                           columns=[{"name": "Color", "id": "id"},
                                                                                    {"name": "Move Count",
@@ -34,32 +63,79 @@ def init_server(host="0.0.0.0", port=8080):
                                         n_intervals=0), ],
                           style={"width": "80%", "margin": "auto", "font-family": "Comic Sans MS"})
 
-    def open_browser():
-        webbrowser.open(f"http://{host}:{port}")
-
     @app.callback(Output('cp-chart', 'figure'), Output('move-table', 'data'),
                   Input('interval-component', 'n_intervals'))
     def update_layout(n):
         try:
-            with open("evaluation.json", "r") as f:
-                data = json.load(f)
-                # print(data)
+            history = EvaluationHistory.open(history_path)
+        except FileNotFoundError:
+            return {}, []
 
-            df = pd.DataFrame(data)
+        black = history.side(BLACK)
+        white = history.side(WHITE)
 
-            figure = {"data": [
-                {"x": df[df["id"] == "black"]["move_count"], "y": df[df["id"] == "black"]["cp"], "type": "line",
-                 "name": "Black", },
-                {"x": df[df["id"] == "white"]["move_count"], "y": df[df["id"] == "white"]["cp"], "type": "line",
-                 "name": "White", }, ],
-                "layout": {"title": "Centipawn Plot", "xaxis_title": "Move Count", "yaxis_title": "Centipawn", }, }
+        figure = {"data": [
+            {"x": black["move_count"], "y": black["cp"], "type": "line", "name": "Black", },
+            {"x": white["move_count"], "y": white["cp"], "type": "line", "name": "White", }, ],
+            "layout": {"title": "Centipawn Plot", "xaxis_title": "Move Count", "yaxis_title": "Centipawn", }, }
 
-            data = df.to_dict("records")
+        return figure, history.rows()
 
-            return figure, data
+    @app.callback(Output('stats-table', 'data'), Input('interval-component', 'n_intervals'))
+    def update_stats(n):
+        try:
+            history = EvaluationHistory.open(history_path)
+        except FileNotFoundError:
+            return []
 
-        except (json.JSONDecodeError, KeyError):
-            return {}, []
+        rows = history.summary()
+        for row in rows:
+            row["time_profile"] = " / ".join(str(count) for count in row["time_profile"])
+        return rows
+
+    @app.server.route("/export/games")
+    def export_games():
+        games = export.list_games(live_pgn())
+        return flask.jsonify([{"game": game_id, "white": game["white"], "black": game["black"]}
+                              for game_id, game in games.items()])
+
+    @app.server.route("/export/evaluations.<fmt>")
+    def export_evaluations(fmt):
+        """
+        Streams evaluation records in chunks as csv, jsonl, arrow or parquet.
+        Query parameters, all optional: game (repeatable or comma separated
+        ids from /export/games), player (name, white or black), from and to
+        (move count range, inclusive).
+        """
+        if fmt not in export.FORMATS:
+            flask.abort(404)
+        mimetype, stream, needs_arrow = export.FORMATS[fmt]
+        if needs_arrow and export.pa is None:
+            return flask.Response("pyarrow is not installed", status=501, mimetype="text/plain")
+
+        args = flask.request.args
+        games = export.list_games(live_pgn())
+        wanted = [game_id for value in args.getlist("game") for game_id in value.split(",") if game_id]
+        if wanted:
+            games = {game_id: games[game_id] for game_id in wanted if game_id in games}
+        try:
+            first = int(args["from"]) if "from" in args else None
+            last = int(args["to"]) if "to" in args else None
+        except ValueError:
+            flask.abort(400)
+
+        chunks = export.iter_chunks(games, args.get("player"), first, last)
+        return flask.Response(flask.stream_with_context(stream(chunks)), mimetype=mimetype,
+                              headers={"Content-Disposition": f"attachment; filename=evaluations.{fmt}"})
+
+    return app
+
+
+def init_server(host="0.0.0.0", port=8080):
+    app = create_app()
+
+    def open_browser():
+        webbrowser.open(f"http://{host}:{port}")
 
     browser_thread = threading.Thread(target=open_browser, daemon=True)
     browser_thread.start()
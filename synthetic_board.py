@@ -0,0 +1,240 @@
+import argparse
+import math
+import os
+from time import perf_counter, sleep
+
+import chess
+import cv2 as cv
+import numpy as np
+
+from move_detector import MoveDetector
+from util import IMAGE_PATH
+
+LIGHT_SQUARE = (200, 225, 235)  # BGR
+DARK_SQUARE = (45, 75, 110)
+BORDER = (30, 45, 70)
+TABLE = (70, 70, 70)
+
+
+class SyntheticCamera:
+    def __init__(self, fen=chess.STARTING_FEN, width=1920, height=1080, board_size=0.8, tilt=0.0, rotation=0.0,
+                 light=1.0, shading=0.0, noise=0.0, fps=0.0, flipped=False, seed=0):
+        """Renders a chess board in perspective, read like a cv.VideoCapture.
+
+        The board is drawn from a FEN with the Images/60 sprites, warped to
+        the camera angle and lit, and cached until the position or the
+        settings change. Every read only adds sensor noise to the cached
+        image, so reads are cheap enough to load-test detection.
+
+        Args:
+          fen: starting position
+          width: frame width in pixels
+          height: frame height in pixels
+          board_size: board width as a share of the frame height
+          tilt: camera tilt from straight above in degrees, foreshortens the far side
+          rotation: board rotation in the image plane in degrees
+          light: overall brightness gain
+          shading: how much darker the far corner is than the near one, 0 to 1
+          noise: standard deviation of the per frame Gaussian noise
+          fps: frames per second read blocks to, 0 for as fast as possible
+          flipped: black at the bottom of the image instead of white
+          seed: noise random seed
+        """
+        self.board = chess.Board(fen)
+        self.width = width
+        self.height = height
+        self.board_size = board_size
+        self.tilt = tilt
+        self.rotation = rotation
+        self.light = light
+        self.shading = shading
+        self.noise = noise
+        self.fps = fps
+        self.flipped = flipped
+        cv.setRNGSeed(seed)
+
+        self.sprites = {}
+        for symbol in "pnbrqkPNBRQK":
+            name = ("w" if symbol.isupper() else "b") + symbol.upper() + ".png"
+            self.sprites[symbol] = cv.imread(os.path.join(IMAGE_PATH, name), cv.IMREAD_UNCHANGED)
+
+        self.frame = None
+        self.gain = None
+        self.noise_fields = None
+        self.next_read = None
+        self.frames = 0
+
+    def corners(self):
+        """Returns where the corners of the board image land in the frame: top left, top right, bottom right, bottom left."""
+        half = self.board_size * self.height / 2
+        foreshortening = math.sin(math.radians(self.tilt))
+        top = half * (1 - 0.3 * foreshortening)
+        depth = half * math.cos(math.radians(self.tilt))
+        points = np.float32([[-top, -depth], [top, -depth], [half, depth], [-half, depth]])
+        angle = math.radians(self.rotation)
+        rotate = np.float32([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+        return points @ rotate.T + np.float32([self.width / 2, self.height / 2])
+
+    def render_board(self, square=120, border=40):
+        """Returns the board seen from straight above, with its pieces."""
+        size = 8 * square + 2 * border
+        img = np.empty((size, size, 3), np.uint8)
+        img[:] = BORDER
+        piece_size = int(square * 0.9)
+        offset = (square - piece_size) // 2
+        for rank in range(8):
+            for file in range(8):
+                row, col = (rank, 7 - file) if self.flipped else (7 - rank, file)
+                y, x = border + row * square, border + col * square
+                tile = img[y:y + square, x:x + square]
+                tile[:] = LIGHT_SQUARE if (rank + file) % 2 else DARK_SQUARE
+
+                piece = self.board.piece_at(chess.square(file, rank))
+                if piece is None:
+                    continue
+                sprite = cv.resize(self.sprites[piece.symbol()], (piece_size, piece_size), interpolation=cv.INTER_AREA)
+                alpha = sprite[:, :, 3:] / 255.0
+                area = tile[offset:offset + piece_size, offset:offset + piece_size]
+                area[:] = (alpha * sprite[:, :, :3] + (1 - alpha) * area).astype(np.uint8)
+        return img
+
+    def render(self):
+        """Renders the current position into the cached clean frame."""
+        board = self.render_board()
+        h, w = board.shape[:2]
+        src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        warp = cv.getPerspectiveTransform(src, self.corners())
+        frame = cv.warpPerspective(board, warp, (self.width, self.height), flags=cv.INTER_LINEAR,
+                                   borderMode=cv.BORDER_CONSTANT, borderValue=TABLE)
+
+        if self.gain is None:
+            # Light falls off from the bottom left corner towards the top right
+            ys, xs = np.mgrid[0:self.height, 0:self.width].astype(np.float32)
+            distance = (xs / self.width + (1 - ys / self.height)) / 2
+            self.gain = cv.merge([self.light * (1 - self.shading * distance)] * 3)
+            # A few noise fields drawn up front and cycled, drawing one per read would dominate read time
+            self.noise_fields = [cv.randn(np.empty(frame.shape, np.int16), 0, self.noise) for _ in range(8)]
+        self.frame = cv.multiply(frame, self.gain, dtype=cv.CV_8U)
+
+    # Positions are rendered when they are set, so reads time only the camera
+    def set_fen(self, fen):
+        self.board.set_fen(fen)
+        self.render()
+
+    def push(self, move):
+        """Plays a move, given as a chess.Move or in UCI."""
+        if not isinstance(move, chess.Move):
+            move = chess.Move.from_uci(move)
+        self.board.push(move)
+        self.render()
+
+    def pop(self):
+        move = self.board.pop()
+        self.render()
+        return move
+
+    def read(self, image=None):
+        """Returns (True, frame) like cv.VideoCapture.read, reusing image when it has the frame's shape."""
+        if self.fps:
+            now = perf_counter()
+            if self.next_read is None or self.next_read < now:
+                # Fell behind, a camera drops frames rather than catching up
+                self.next_read = now
+            else:
+                sleep(self.next_read - now)
+            self.next_read += 1 / self.fps
+
+        if self.frame is None:
+            self.render()
+        if image is None or image.shape != self.frame.shape or image.dtype != np.uint8:
+            image = np.empty_like(self.frame)
+        if self.noise:
+            noise = self.noise_fields[self.frames % len(self.noise_fields)]
+            cv.add(self.frame, noise, dst=image, dtype=cv.CV_8U)
+        else:
+            np.copyto(image, self.frame)
+        self.frames += 1
+        return True, image
+
+    def grab(self):
+        return True
+
+    def set(self, prop, value):
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+        elif prop == cv.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+        elif prop == cv.CAP_PROP_FPS:
+            self.fps = value
+        else:
+            return False
+        self.frame = None
+        self.gain = None
+        return True
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv.CAP_PROP_FPS:
+            return self.fps
+        return 0
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        self.frame = None
+
+
+class SyntheticDetector(MoveDetector):
+    """MoveDetector keeping its calibration apart from the real camera's."""
+    directory = "output/synthetic"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test calibration and move detection on a rendered board.")
+    parser.add_argument("--moves", nargs="+", default="e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 d2d3 f8e7".split(),
+                        help="moves played in UCI")
+    parser.add_argument("--fps", type=float, default=0, help="camera frame rate, 0 for unthrottled")
+    parser.add_argument("--tilt", type=float, default=15)
+    parser.add_argument("--rotation", type=float, default=2)
+    parser.add_argument("--shading", type=float, default=0.3)
+    parser.add_argument("--noise", type=float, default=6)
+    parser.add_argument("--levels", type=int, default=1, help="detector image pyramid levels")
+    args = parser.parse_args()
+
+    camera = SyntheticCamera(chess.STARTING_BOARD_FEN + " w - - 0 1", tilt=args.tilt, rotation=args.rotation,
+                             shading=args.shading, noise=args.noise, fps=args.fps)
+    # Calibration needs the empty board, like on the real one
+    camera.set_fen("8/8/8/8/8/8/8/8 w - - 0 1")
+    calibration = os.path.join(SyntheticDetector.directory, "boxes.json")
+    if os.path.isfile(calibration):
+        os.remove(calibration)
+    start = perf_counter()
+    detector = SyntheticDetector(camera, levels=args.levels)
+    print(f"calibration:    {1000 * (perf_counter() - start):.0f} ms")
+
+    camera.set_fen(chess.STARTING_FEN)
+    detector.takePicture()
+    correct = 0
+    elapsed = 0.0
+    frames = camera.frames
+    for uci in args.moves:
+        move = chess.Move.from_uci(uci)
+        camera.push(move)
+        start = perf_counter()
+        squares, margin = detector.detectMove()
+        elapsed += perf_counter() - start
+        expected = {chess.square_name(move.from_square), chess.square_name(move.to_square)}
+        correct += expected == set(squares)
+        print(f"{uci}: detected {squares[0]}{squares[1]} margin {margin:.2f}")
+    frames = camera.frames - frames
+    print(f"correct:        {correct}/{len(args.moves)}")
+    print(f"mean detection: {1000 * elapsed / len(args.moves):.1f} ms over {frames / len(args.moves):.1f} frames")
+    return 0 if correct == len(args.moves) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
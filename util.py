@@ -1,10 +1,111 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
 import os
 import platform as sys_plat
+import queue
 import sys
+import threading
+import time
 
-log_format = "%(asctime)s :: %(funcName)s :: line: %(lineno)d :: %(levelname)s :: %(message)s"
-logging.basicConfig(filename="pecg_log.txt", filemode="w", level=logging.DEBUG, format=log_format)
+LOG_FILE = "pecg_log.txt"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 5
+
+# Attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, including extra= fields such as stage and ms."""
+
+    def format(self, record):
+        event = {"time": self.formatTime(record), "level": record.levelname, "func": record.funcName,
+                 "line": record.lineno, "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                event[key] = value
+        # Tracebacks arrive formatted by TracebackQueueHandler
+        if record.exc_text:
+            event["exc"] = record.exc_text
+        return json.dumps(event, default=str)
+
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps a record's traceback apart from its message.
+
+    The stock prepare() formats the traceback into the message and drops
+    exc_info. Here the message only has its arguments merged and the
+    traceback travels as exc_text, for JsonFormatter's exc field. extra=
+    fields are kept either way.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        # Tracebacks hold frames, which must not outlive the call or cross to another process
+        record.exc_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most burst records per call site every interval seconds.
+
+    The number of dropped records is attached to the next one let through as
+    the suppressed field.
+    """
+
+    def __init__(self, burst=10, interval=10.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.sites = {}  # (pathname, lineno) -> [window start, count, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self.lock:
+            site = self.sites.setdefault((record.pathname, record.lineno), [now, 0, 0])
+            if now - site[0] >= self.interval:
+                site[0], site[1] = now, 0
+            if site[1] >= self.burst:
+                site[2] += 1
+                return False
+            site[1] += 1
+            if site[2]:
+                record.suppressed = site[2]
+                site[2] = 0
+        return True
+
+
+def setup_logging(filename=LOG_FILE, level=logging.DEBUG):
+    """
+    Send log records through a queue to a background thread that writes them
+    as JSON lines to a rotating file, so callers never wait on disk I/O.
+    """
+    log_queue = queue.Queue(-1)
+    queue_handler = TracebackQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    file_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    return listener
+
+
+setup_logging()
 
 APP_NAME = "ELEC3442 Chess"
 APP_VERSION = "v1.0.0_beta6.9"
@@ -17,6 +118,12 @@ GUI_THEME = ["Dark", "Black", "Reddit"]
 
 IMAGE_PATH = "Images/60"  # path to the chess pieces
 
+CHECKPOINT_PATH = "output/checkpoint.json"  # unfinished game, see EasyChessGui.save_checkpoint
+
+# Keep the frames of every detection in output/recordings, see recorder.SessionRecorder
+RECORD_DETECTIONS = False
+RECORD_VIDEO_FPS = 0  # also record the camera as video at this rate for the whole session, 0 for none
+
 BLANK = 0  # piece names
 PAWNB = 1
 KNIGHTB = 2
@@ -31,6 +138,10 @@ ROOKW = 10
 KINGW = 11
 QUEENW = 12
 
+# python-chess piece symbol to piece name
+PIECE_SYMBOLS = {"p": PAWNB, "n": KNIGHTB, "b": BISHOPB, "r": ROOKB, "k": KINGB, "q": QUEENB, "P": PAWNW, "N": KNIGHTW,
+                 "B": BISHOPW, "R": ROOKW, "K": KINGW, "Q": QUEENW, }
+
 # Absolute rank based on real chess board, white at bottom, black at the top.
 # This is also the rank mapping used by python-chess modules.
 RANK_8 = 7
@@ -46,24 +157,6 @@ initial_board = [[ROOKB, KNIGHTB, BISHOPB, QUEENB, KINGB, BISHOPB, KNIGHTB, ROOK
                  [BLANK, ] * 8, [BLANK, ] * 8, [BLANK, ] * 8, [PAWNW, ] * 8,
                  [ROOKW, KNIGHTW, BISHOPW, QUEENW, KINGW, BISHOPW, KNIGHTW, ROOKW], ]
 
-eval_list = []
-best_move_white = []
-best_move_black = []
-wdl_white = []
-wdl_black = []
-
-evaluation_dictionary = []
-
-"""
-evaluation = [
-    id: (black or white),
-    move: best move,
-    wdl: win, draw, loss,
-    mate: mate in n,
-    score: evaluation score,
-]
-"""
-
 # Images/60
 blank = os.path.join(IMAGE_PATH, "blank.png")
 bishopB = os.path.join(IMAGE_PATH, "bB.png")
@@ -82,6 +175,12 @@ kingW = os.path.join(IMAGE_PATH, "wK.png")
 images = {BISHOPB: bishopB, BISHOPW: bishopW, PAWNB: pawnB, PAWNW: pawnW, KNIGHTB: knightB, KNIGHTW: knightW,
           ROOKB: rookB, ROOKW: rookW, KINGB: kingB, KINGW: kingW, QUEENB: queenB, QUEENW: queenW, BLANK: blank, }
 
+# Board color menu entries: light square, dark square, light and dark move highlight
+BOARD_COLORS = {"Brown::board_color_k": ("#F0D9B5", "#B58863", "#E8E18E", "#B8AF4E"),
+                "Blue::board_color_k": ("#b9d6e8", "#4790c0", "#d2e4ba", "#91bc9c"),
+                "Green::board_color_k": ("#daf1e3", "#3a7859", "#bae58f", "#6fbc55"),
+                "Gray::board_color_k": ("#D8D8D8", "#808080", "#e0e0ad", "#999966"), }
+
 # (1) Mode: Neutral
 menu_def_neutral = [["&Mode", ["Play"]], ["Boar&d", ["Flip", "Color", ["Brown::board_color_k", "Blue::board_color_k",
                                                                        "Green::board_color_k", "Gray::board_color_k", ],